@@ -0,0 +1,59 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+"""
+
+from abc import ABC, abstractmethod
+from typing import Iterator, List, Optional, Sequence
+
+THROTTLED_HTTP_STATUS = 429
+
+
+class BackendError(Exception):
+    # mirrors `CohereError`, so that retries and fallbacks treat all backends alike
+    def __init__(self, message: str, http_status: Optional[int] = None):
+        super().__init__(message)
+        self.message = message
+        self.http_status = http_status
+
+
+class Backend(ABC):
+    """
+    Embeds, generates and tokenizes text. Every backend has the models it uses by default,
+    embeddings of different models are never mixed, since they are cached by model.
+    """
+    embedding_model: str
+    generation_model: str
+
+    @abstractmethod
+    def embed(self, texts: Sequence[str], model: str) -> List[Sequence[float]]:
+        ...
+
+    @abstractmethod
+    def generate(self, prompt: str, model: str, max_tokens: int, temperature: float,
+                 stop_sequences: Sequence[str] = ()) -> Iterator[str]:
+        # yields the generated text chunk by chunk
+        ...
+
+    @abstractmethod
+    def tokenize(self, text: str, model: str) -> List[int]:
+        ...
+
+
+class Generation:
+    """
+    Chunks of a generated text and the model generating them. A backend that falls back to another model sets
+    `model` before the first chunk of the other model, so it is the model of the whole text once it is consumed.
+    """
+
+    def __init__(self, chunks: Iterator[str], model: str):
+        self.chunks = chunks
+        self.model = model
+
+    def __iter__(self) -> Iterator[str]:
+        return self.chunks
+
+
+def is_throttled(error: Exception) -> bool:
+    return getattr(error, 'http_status', None) == THROTTLED_HTTP_STATUS
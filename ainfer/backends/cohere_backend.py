@@ -0,0 +1,36 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+"""
+
+from typing import Iterator, List, Sequence
+
+from ainfer.backends.base import Backend
+from ainfer.generation import stream_generation
+from ainfer.metrics import timed_remote_call
+
+EMBEDDING_MODEL = 'multilingual-22-12'
+GENERATION_MODEL = 'command-medium-nightly'
+
+
+class CohereBackend(Backend):
+    embedding_model = EMBEDDING_MODEL
+    generation_model = GENERATION_MODEL
+
+    def __init__(self, co):
+        self.co = co
+
+    @timed_remote_call('embed')
+    def embed(self, texts: Sequence[str], model: str) -> List[Sequence[float]]:
+        return self.co.embed(texts=list(texts), model=model).embeddings
+
+    def generate(self, prompt: str, model: str, max_tokens: int, temperature: float,
+                 stop_sequences: Sequence[str] = ()) -> Iterator[str]:
+        return stream_generation(self.co, model=model, prompt=prompt, max_tokens=max_tokens,
+                                 temperature=temperature, stop_sequences=stop_sequences)
+
+    @timed_remote_call('tokenize')
+    def tokenize(self, text: str, model: str) -> List[int]:
+        # the installed SDK tokenizes with the default tokenizer only
+        return self.co.tokenize(text=text).tokens
@@ -0,0 +1,30 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+"""
+
+import os
+from functools import lru_cache
+
+import cohere
+
+from ainfer.backends.base import Backend
+from ainfer.backends.cohere_backend import CohereBackend
+from ainfer.backends.fake import FakeBackend
+from ainfer.backends.fallback import FallbackBackend
+from ainfer.backends.local import HashingBackend
+
+BACKEND = os.environ.get('AINFER_BACKEND', 'cohere')  # cohere, local or fake
+
+
+@lru_cache(maxsize=None)
+def get_backend(name: str = BACKEND, api_key: str = '') -> Backend:
+    # backends are shared between sessions, so that the fallback state outlives a rerun
+    if name == 'cohere':
+        return FallbackBackend(CohereBackend(cohere.Client(api_key)), HashingBackend())
+    if name == 'local':
+        return HashingBackend()
+    if name == 'fake':
+        return FakeBackend()
+    raise ValueError(f'Unknown backend: {name}.')
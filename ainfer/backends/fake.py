@@ -0,0 +1,74 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+"""
+
+import time
+import hashlib
+import threading
+from typing import Iterator, List, Sequence
+
+import numpy as np
+
+from ainfer.backends.base import Backend, BackendError, THROTTLED_HTTP_STATUS
+from ainfer.backends.local import tokenize_locally
+
+FAKE_EMBEDDING_DIMENSION = 768
+FAKE_EMBEDDING_MODEL = f'fake-{FAKE_EMBEDDING_DIMENSION}'
+FAKE_GENERATION_MODEL = 'fake'
+FAKE_GENERATION_TOKENS_COUNT = 64
+
+
+class FakeBackend(Backend):
+    """
+    Deterministic stand-in for a remote backend: the same text always gets the same embedding and the same prompt
+    the same generation. Latencies are simulated with sleeps, so that the pipeline can be load-tested offline.
+    With `throttle_every` set, every n-th request fails the way a throttled API does.
+    """
+    embedding_model = FAKE_EMBEDDING_MODEL
+    generation_model = FAKE_GENERATION_MODEL
+
+    def __init__(self, embed_latency: float = 0.0, embed_latency_per_text: float = 0.0,
+                 first_token_latency: float = 0.0, token_latency: float = 0.0, throttle_every: int = 0,
+                 dimension: int = FAKE_EMBEDDING_DIMENSION):
+        self.embed_latency = embed_latency
+        self.embed_latency_per_text = embed_latency_per_text
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.throttle_every = throttle_every
+        self.dimension = dimension
+        self.requests_count = 0
+        self._lock = threading.Lock()
+
+    def embed(self, texts: Sequence[str], model: str) -> List[Sequence[float]]:
+        self._count_request()
+        time.sleep(self.embed_latency + self.embed_latency_per_text * len(texts))
+        return [_seeded_random(text, model).standard_normal(self.dimension, dtype=np.float32) for text in texts]
+
+    def generate(self, prompt: str, model: str, max_tokens: int, temperature: float,
+                 stop_sequences: Sequence[str] = ()) -> Iterator[str]:
+        self._count_request()
+        words = prompt.split() or ['empty']
+        random = _seeded_random(prompt, model)
+        time.sleep(self.first_token_latency)
+        for i in range(min(max_tokens, FAKE_GENERATION_TOKENS_COUNT)):
+            if i:
+                time.sleep(self.token_latency)
+            yield ' ' + words[random.integers(len(words))]
+
+    def tokenize(self, text: str, model: str) -> List[int]:
+        self._count_request()
+        return tokenize_locally(text)
+
+    def _count_request(self):
+        with self._lock:
+            self.requests_count += 1
+            throttled = self.throttle_every and self.requests_count % self.throttle_every == 0
+        if throttled:
+            raise BackendError('Too many requests.', http_status=THROTTLED_HTTP_STATUS)
+
+
+def _seeded_random(text: str, model: str) -> np.random.Generator:
+    seed = hashlib.blake2b(f'{model}\0{text}'.encode(), digest_size=8).digest()
+    return np.random.default_rng(int.from_bytes(seed, 'little'))
@@ -0,0 +1,93 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+"""
+
+import time
+import logging
+from typing import Iterator, List, Sequence
+
+from ainfer.backends.base import Backend, Generation, is_throttled
+
+LOGGER = logging.getLogger(__name__)
+FALLBACK_COOLDOWN = 60.0  # seconds the fallback is used for after the primary backend throttled a request
+
+
+class FallbackBackend(Backend):
+    """
+    Uses the primary backend until it throttles a request, then the fallback one for FALLBACK_COOLDOWN seconds.
+    Generations and tokenizations are retried with the fallback right away, a generation tells which model it came
+    from, so that answers of the fallback are not taken for those of the primary backend. Embeddings of different models
+    cannot be compared, so the failed embedding request is not retried: `embedding_model` switches to the model
+    of the fallback instead, and the next ranking embeds everything with it.
+    """
+
+    def __init__(self, primary: Backend, fallback: Backend):
+        self.primary = primary
+        self.fallback = fallback
+        self._throttled_until = 0.0
+
+    @property
+    def embedding_model(self) -> str:
+        return self._active.embedding_model
+
+    @property
+    def generation_model(self) -> str:
+        return self._active.generation_model
+
+    @property
+    def _active(self) -> Backend:
+        return self.fallback if time.monotonic() < self._throttled_until else self.primary
+
+    def embed(self, texts: Sequence[str], model: str) -> List[Sequence[float]]:
+        if model == self.fallback.embedding_model:
+            return self.fallback.embed(texts, model)
+        try:
+            return self.primary.embed(texts, model)
+        except Exception as e:
+            self._check_throttled(e)
+            raise
+
+    def generate(self, prompt: str, model: str, max_tokens: int, temperature: float,
+                 stop_sequences: Sequence[str] = ()) -> Generation:
+        generation = Generation(iter(()), model)
+        generation.chunks = self._generate(generation, prompt, model, max_tokens, temperature, stop_sequences)
+        return generation
+
+    def _generate(self, generation: Generation, prompt: str, model: str, max_tokens: int, temperature: float,
+                  stop_sequences: Sequence[str]) -> Iterator[str]:
+        if self._active is self.primary and model != self.fallback.generation_model:
+            chunks = self.primary.generate(prompt, model, max_tokens, temperature, stop_sequences)
+            try:
+                # the primary backend can only be given up on before it produced any text
+                first_chunk = next(chunks, None)
+            except Exception as e:
+                self._check_throttled(e)
+                if not is_throttled(e):
+                    raise
+            else:
+                if first_chunk is not None:
+                    yield first_chunk
+                    yield from chunks
+                return
+
+        generation.model = self.fallback.generation_model
+        yield from self.fallback.generate(prompt, self.fallback.generation_model, max_tokens, temperature,
+                                          stop_sequences)
+
+    def tokenize(self, text: str, model: str) -> List[int]:
+        if self._active is self.primary:
+            try:
+                return self.primary.tokenize(text, model)
+            except Exception as e:
+                self._check_throttled(e)
+                if not is_throttled(e):
+                    raise
+        return self.fallback.tokenize(text, model)
+
+    def _check_throttled(self, error: Exception):
+        if is_throttled(error):
+            LOGGER.warning('%s is throttled (%s), falling back to %s for %.0f s.', type(self.primary).__name__,
+                           error, type(self.fallback).__name__, FALLBACK_COOLDOWN)
+            self._throttled_until = time.monotonic() + FALLBACK_COOLDOWN
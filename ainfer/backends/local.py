@@ -0,0 +1,105 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+"""
+
+import re
+import hashlib
+from typing import Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+from ainfer.backends.base import Backend
+from ainfer.prompt import TOKEN_PATTERN, ANSWER_PROMPT_TEMPLATE, SUMMARY_PROMPT_TEMPLATE, estimate_tokens_count
+
+EMBEDDING_DIMENSION = 1024
+LOCAL_EMBEDDING_MODEL = f'hashing-{EMBEDDING_DIMENSION}'
+LOCAL_GENERATION_MODEL = 'extractive'
+SENTENCE_PATTERN = re.compile(r'[^.!?\n]+[.!?]*')
+
+
+def _compile_template(template: str) -> re.Pattern:
+    pattern = re.escape(template)
+    for field in ('context', 'question'):
+        pattern = pattern.replace(re.escape(f'{{{field}}}'), f'(?P<{field}>.*)')
+    return re.compile(pattern, re.DOTALL)
+
+
+PROMPT_PATTERNS = (_compile_template(ANSWER_PROMPT_TEMPLATE), _compile_template(SUMMARY_PROMPT_TEMPLATE))
+
+
+class HashingBackend(Backend):
+    """
+    Runs on the CPU without any model: texts are embedded with a signed hashing vectorizer over words and word pairs,
+    and generation extracts the sentences of the context closest to the question.
+    Meant for benchmarks and as a fallback, its answers are far worse than the ones of a language model.
+    """
+    embedding_model = LOCAL_EMBEDDING_MODEL
+    generation_model = LOCAL_GENERATION_MODEL
+
+    def embed(self, texts: Sequence[str], model: str) -> List[Sequence[float]]:
+        return list(embed_locally(texts))
+
+    def generate(self, prompt: str, model: str, max_tokens: int, temperature: float,
+                 stop_sequences: Sequence[str] = ()) -> Iterator[str]:
+        context, question = _split_prompt(prompt)
+        sentences = [match.group().strip() for match in SENTENCE_PATTERN.finditer(context)]
+        sentences = [sentence for sentence in sentences if sentence]
+        if not sentences:
+            return
+
+        embeddings = embed_locally(sentences)
+        # without a question the sentences closest to the whole context summarize it best
+        target = embed_locally((question,))[0] if question else embeddings.sum(axis=0)
+        order = np.argsort(-(embeddings @ target), kind='stable')
+
+        chosen, tokens_count = [], 0
+        for i in order:
+            sentence_tokens_count = estimate_tokens_count(sentences[i])
+            if tokens_count + sentence_tokens_count > max_tokens:
+                break
+            chosen.append(i)
+            tokens_count += sentence_tokens_count
+
+        for i in sorted(chosen):
+            yield ' ' + sentences[i]
+
+    def tokenize(self, text: str, model: str) -> List[int]:
+        return tokenize_locally(text)
+
+
+def embed_locally(texts: Sequence[str], dimension: int = EMBEDDING_DIMENSION) -> np.ndarray:
+    embeddings = np.zeros((len(texts), dimension), dtype=np.float32)
+    for row, text in enumerate(texts):
+        words = [word.lower() for word in TOKEN_PATTERN.findall(text)]
+        features = words + [f'{first} {second}' for first, second in zip(words, words[1:])]
+        for feature in features:
+            index, sign = _hash_feature(feature, dimension)
+            embeddings[row, index] += sign
+
+    # sublinear term frequencies, so that repeated words do not dominate
+    np.copysign(np.log1p(np.abs(embeddings)), embeddings, out=embeddings)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    np.divide(embeddings, norms, out=embeddings, where=norms > 0)
+    return embeddings
+
+
+def tokenize_locally(text: str) -> List[int]:
+    return [int.from_bytes(hashlib.blake2b(token.encode(), digest_size=4).digest(), 'little')
+            for token in TOKEN_PATTERN.findall(text)]
+
+
+def _hash_feature(feature: str, dimension: int) -> Tuple[int, float]:
+    value = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'little')
+    return (value >> 1) % dimension, 1.0 if value & 1 else -1.0
+
+
+def _split_prompt(prompt: str) -> Tuple[str, str]:
+    # the prompts are built from the templates of `ainfer.prompt`, anything else is taken as context
+    for pattern in PROMPT_PATTERNS:
+        match = pattern.fullmatch(prompt)
+        if match:
+            fields = match.groupdict()
+            return fields['context'], fields.get('question', '').strip()
+    return prompt, ''
@@ -4,12 +4,49 @@
  Date: Feb 03 2023
 """
 
-from typing import List
-from itertools import chain
-
-import streamlit as st
-
-from ainfer.types.files import File, ParsedFile
+import hashlib
+import threading
+from collections import Counter
+from operator import itemgetter
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+from cachetools import LRUCache, TTLCache
+
+from ainfer.types.files import File, ParsedFile, Paragraphs, ParagraphsCoordinates
+from ainfer.types.ranking import EmbeddingMatrix, RankedParagraph
+from ainfer.embeddings.index import IVFFileLists
+from ainfer.lexical.bm25 import BM25Index
+from ainfer.memory import get_session_files
+from ainfer.metrics import CACHE_REQUESTS, increment
+
+EMBEDDINGS_CACHE_MAX_BYTES = 512 * 1024 * 1024
+IVF_INDEXES_CACHE_MAX_BYTES = 512 * 1024 * 1024
+PARSED_PARAGRAPHS_CACHE_MAX_BYTES = 256 * 1024 * 1024
+PARSED_PAGES_CACHE_MAX_BYTES = 128 * 1024 * 1024
+HIGHLIGHTS_CACHE_MAX_BYTES = 64 * 1024 * 1024
+ANSWERS_CACHE_MAX_SIZE = 10_000  # number of contexts
+ANSWERS_CACHE_TTL = 24 * 60 * 60  # seconds
+ANSWERS_PER_CONTEXT_MAX_COUNT = 16
+USE_SEMANTIC_ANSWER_CACHE = True
+SEMANTIC_ANSWER_CACHE_THRESHOLD = 0.95  # cosine similarity of the questions' embeddings
+CACHED_FILES_KEY = '_cached_files'
+
+# Shared by all sessions of the process and keyed by file content, so that the same paper
+# is assembled from the embedding store only once. The store itself persists across processes.
+_EMBEDDINGS_CACHE = LRUCache(maxsize=EMBEDDINGS_CACHE_MAX_BYTES, getsizeof=lambda embeddings: embeddings.vectors.nbytes)
+_EMBEDDINGS_CACHE_LOCK = threading.Lock()
+
+# Files' parts of the index lists, keyed by file content hash and model, an index over a set of files is made of them
+_IVF_INDEXES_CACHE = LRUCache(maxsize=IVF_INDEXES_CACHE_MAX_BYTES, getsizeof=lambda file_lists: file_lists.nbytes)
+_IVF_INDEXES_CACHE_LOCK = threading.Lock()
+
+# Answers shared by all sessions, keyed by the context they were generated from.
+# A value is a tuple of the cached answers to the latest questions about the context.
+_ANSWERS_CACHE = TTLCache(maxsize=ANSWERS_CACHE_MAX_SIZE, ttl=ANSWERS_CACHE_TTL)
+_ANSWERS_CACHE_LOCK = threading.Lock()
+_ANSWER_CACHE_STATS = Counter(hits=0, semantic_hits=0, misses=0)
+_ANSWER_CACHE_RESULTS = {'hits': 'hit', 'semantic_hits': 'semantic_hit', 'misses': 'miss'}  # metrics labels
 
 
 def cache_files(files: List[File]):
@@ -18,7 +55,8 @@ def cache_files(files: List[File]):
 
 
 def cache_file(file: File):
-    st.session_state[file.name] = file.value
+    # the session keeps a handle only, the content is stored once per process in the blob store
+    get_session_files(CACHED_FILES_KEY).add(file)
 
 
 def get_files_from_cache(names: List[str]) -> List[File]:
@@ -26,32 +64,168 @@ def get_files_from_cache(names: List[str]) -> List[File]:
 
 
 def get_file_from_cache(name: str) -> File:
-    return File(name=name, value=st.session_state[name])
+    return get_session_files(CACHED_FILES_KEY).get(name)
+
+
+# Parsing results of every file the process has seen, keyed by the file content hash.
+# Paragraphs and coordinates are cached in their compact form, so a hit costs no decoding.
+# The lexical index built at parse time is kept along, it is evicted together with the paragraphs it indexes.
+_PARSED_PARAGRAPHS_CACHE = LRUCache(maxsize=PARSED_PARAGRAPHS_CACHE_MAX_BYTES,
+                                    getsizeof=lambda parsed: sum(part.nbytes for part in parsed))
+_PARSED_PARAGRAPHS_CACHE_LOCK = threading.Lock()
+
+
+def cache_parsed_paragraphs(parsed_file: ParsedFile, lexical_index: BM25Index):
+    with _PARSED_PARAGRAPHS_CACHE_LOCK:
+        _put(_PARSED_PARAGRAPHS_CACHE, parsed_file.digest,
+             (parsed_file.paragraphs, parsed_file.paragraphs_coordinates, lexical_index))
+
+
+# getters return None on a miss, an entry can be evicted by another session between a check and a read
+def get_parsed_paragraphs_from_cache(file: File) -> Optional[Tuple[Paragraphs, ParagraphsCoordinates]]:
+    with _PARSED_PARAGRAPHS_CACHE_LOCK:
+        parsed = _PARSED_PARAGRAPHS_CACHE.get(file.digest, None)
+    return None if parsed is None else parsed[:2]
+
+
+def get_lexical_index_from_cache(file: File) -> Optional[BM25Index]:
+    with _PARSED_PARAGRAPHS_CACHE_LOCK:
+        parsed = _PARSED_PARAGRAPHS_CACHE.get(file.digest, None)
+    return None if parsed is None else parsed[-1]
+
+
+# Paragraphs of single pages, so that pages extracted once are not extracted again while the whole file
+# is not parsed yet, for example by a job that was cancelled. Keyed by the file content hash and the page number.
+_PARSED_PAGES_CACHE = LRUCache(maxsize=PARSED_PAGES_CACHE_MAX_BYTES,
+                               getsizeof=lambda page: sum(map(len, page[0])) + 48 * len(page[1]) + 1)
+_PARSED_PAGES_CACHE_LOCK = threading.Lock()
+
+
+def cache_parsed_page(file: File, page_number: int, paragraphs: Tuple[str, ...], paragraphs_coordinates: Tuple):
+    with _PARSED_PAGES_CACHE_LOCK:
+        _put(_PARSED_PAGES_CACHE, (file.digest, page_number), (paragraphs, paragraphs_coordinates))
+
+
+def get_parsed_page_from_cache(file: File, page_number: int) -> Optional[Tuple[Tuple[str, ...], Tuple]]:
+    with _PARSED_PAGES_CACHE_LOCK:
+        return _PARSED_PAGES_CACHE.get((file.digest, page_number), None)
+
+
+def cache_parsed_file_embeddings(parsed_file: ParsedFile, model: str, embeddings: EmbeddingMatrix):
+    with _EMBEDDINGS_CACHE_LOCK:
+        _put(_EMBEDDINGS_CACHE, (parsed_file.digest, model), embeddings)
+
+
+def get_parsed_file_embeddings_from_cache(parsed_file: ParsedFile, model: str) -> Optional[EmbeddingMatrix]:
+    with _EMBEDDINGS_CACHE_LOCK:
+        return _EMBEDDINGS_CACHE.get((parsed_file.digest, model), None)
+
+
+def cache_ivf_file_lists(parsed_file: ParsedFile, model: str, file_lists: IVFFileLists):
+    with _IVF_INDEXES_CACHE_LOCK:
+        _put(_IVF_INDEXES_CACHE, (parsed_file.digest, model), file_lists)
+
+
+def get_ivf_file_lists_from_cache(parsed_file: ParsedFile, model: str) -> Optional[IVFFileLists]:
+    with _IVF_INDEXES_CACHE_LOCK:
+        return _IVF_INDEXES_CACHE.get((parsed_file.digest, model), None)
+
+
+# Highlights of paragraph sets keyed by file content hash and the highlighted paragraphs' indices.
+# A value is the length of the original file prefix and the incremental PDF update that follows it.
+_HIGHLIGHTS_CACHE = LRUCache(maxsize=HIGHLIGHTS_CACHE_MAX_BYTES, getsizeof=lambda highlights: len(highlights[1]))
+_HIGHLIGHTS_CACHE_LOCK = threading.Lock()
+
+
+def cache_highlights(file: File, paragraphs_indices: Tuple[int], highlights: Tuple[int, bytes]):
+    with _HIGHLIGHTS_CACHE_LOCK:
+        _put(_HIGHLIGHTS_CACHE, (file.digest, paragraphs_indices), highlights)
+
+
+def get_highlights_from_cache(file: File, paragraphs_indices: Tuple[int]) -> Optional[Tuple[int, bytes]]:
+    with _HIGHLIGHTS_CACHE_LOCK:
+        return _HIGHLIGHTS_CACHE.get((file.digest, paragraphs_indices), None)
+
+
+class _CachedAnswer(NamedTuple):
+    question: str
+    answer: str
+    generation_model: Optional[str]
+    # embeddings of different models are not comparable, even when their dimensions happen to be the same
+    question_embedding: Optional[np.ndarray]
+    embedding_model: Optional[str]
+
+
+def cache_answer(answer_cache_key: str, question: str, answer: str, question_embedding: Optional[np.ndarray] = None,
+                 embedding_model: Optional[str] = None, generation_model: Optional[str] = None):
+    cached_answer = _CachedAnswer(question, answer, generation_model, question_embedding, embedding_model)
+    with _ANSWERS_CACHE_LOCK:
+        answers = _ANSWERS_CACHE.get(answer_cache_key, ())
+        _ANSWERS_CACHE[answer_cache_key] = (*answers, cached_answer)[-ANSWERS_PER_CONTEXT_MAX_COUNT:]
+
+
+def get_answer_from_cache(answer_cache_key: str, question: str,
+                          question_embedding: Optional[np.ndarray] = None,
+                          embedding_model: Optional[str] = None,
+                          generation_model: Optional[str] = None) -> Optional[str]:
+    # An exact question match goes first. Otherwise, an answer to a question whose embedding is
+    # similar enough is reused, as the key already guarantees that the context is the same.
+    # Only the answers of the generation model are reused, so that those of a fallback model stop being served
+    # once the backend recovers. Only the questions embedded with the same model are compared.
+    with _ANSWERS_CACHE_LOCK:
+        answers = [cached_answer for cached_answer in _ANSWERS_CACHE.get(answer_cache_key, ())
+                   if cached_answer.generation_model == generation_model]
+
+    answer = next((cached_answer.answer for cached_answer in answers if cached_answer.question == question), None)
+    if answer is not None:
+        _count_answer_cache_event('hits')
+        return answer
+
+    if USE_SEMANTIC_ANSWER_CACHE and question_embedding is not None:
+        similar_answers = [(_cosine_similarity(question_embedding, cached_answer.question_embedding),
+                            cached_answer.answer)
+                           for cached_answer in answers
+                           if cached_answer.question_embedding is not None
+                           and cached_answer.embedding_model == embedding_model
+                           and cached_answer.question_embedding.shape == question_embedding.shape]
+        similarity, answer = max(similar_answers, key=itemgetter(0), default=(None, None))
+        if answer is not None and similarity >= SEMANTIC_ANSWER_CACHE_THRESHOLD:
+            _count_answer_cache_event('semantic_hits')
+            return answer
+
+    _count_answer_cache_event('misses')
+    return None
 
 
-def cache_parsed_file_embeddings(parsed_file: ParsedFile, embeddings: List[float]):
-    st.session_state[f'{parsed_file.name}_embeddings'] = embeddings
+def get_answer_cache_stats() -> Dict[str, int]:
+    with _ANSWERS_CACHE_LOCK:
+        return {**_ANSWER_CACHE_STATS, 'size': len(_ANSWERS_CACHE)}
 
 
-def get_parsed_file_embeddings_from_cache(parsed_file: ParsedFile):
-    return st.session_state[f'{parsed_file.name}_embeddings']
+def build_answer_cache_key(paragraphs_for_context: Sequence[RankedParagraph]) -> str:
+    # the same paragraphs of the same files make the same context, whatever the files are called
+    return _hash(f'{file.digest}:{paragraph_index}' for file, _, (_, paragraph_index), _ in paragraphs_for_context)
 
 
-def parsed_file_embeddings_are_cached(parsed_file: ParsedFile) -> bool:
-    return f'{parsed_file.name}_embeddings' in st.session_state
+def build_summary_cache_key(text: str) -> str:
+    return _hash(('summary', text))
 
 
-def cache_answer(answer_cache_key: str, answer: str):
-    st.session_state[answer_cache_key] = answer
+def _put(cache: LRUCache, key, value):
+    # a value larger than the whole cache is not cached, its users keep the one they were given
+    if cache.getsizeof(value) <= cache.maxsize:
+        cache[key] = value
 
 
-def answer_is_cached(answer_cache_key: str) -> bool:
-    return answer_cache_key in st.session_state
+def _hash(parts: Iterable[str]) -> str:
+    return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
 
 
-def get_answer_from_cache(answer_cache_key: str) -> str:
-    return st.session_state[answer_cache_key]
+def _count_answer_cache_event(event: str):
+    with _ANSWERS_CACHE_LOCK:
+        _ANSWER_CACHE_STATS[event] += 1
+    increment(CACHE_REQUESTS, cache='answers', result=_ANSWER_CACHE_RESULTS[event])
 
 
-def build_answer_cache_key(names: List[str], question: str):
-    return ''.join(chain(names, (question,)))
+def _cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.dot(a, b) / max(np.linalg.norm(a) * np.linalg.norm(b), np.finfo(np.float32).tiny))
@@ -10,7 +10,7 @@ import streamlit as st
 
 from ainfer.files.download_file import download_files_from_google_drive
 from ainfer.memory import get_files_from_memory
-from ainfer.types.files import File
+from ainfer.types.files import File, FileFormat
 
 # TODO: Move all the client interaction code from `entrypoint.py` here.
 
@@ -18,11 +18,12 @@ NO_LABEL = ''
 
 
 def file_uploader() -> List[File]:
-    upload_expander = st.sidebar.expander('Upload PDFs')
+    upload_expander = st.sidebar.expander('Upload files')
     with upload_expander:
+        file_formats = [file_format.value for file_format in FileFormat]
         uploaded_files = [
             File(name=uploaded_file.name, value=uploaded_file.getvalue())
-            for uploaded_file in st.file_uploader('From local storage', type=['pdf'], accept_multiple_files=True)
+            for uploaded_file in st.file_uploader('From local storage', type=file_formats, accept_multiple_files=True)
         ]
 
         google_drive_folder_link = st.text_input(
@@ -30,7 +31,7 @@ def file_uploader() -> List[File]:
 
         if google_drive_folder_link:
             google_drive_files = download_files_from_google_drive(google_drive_folder_link)
-            uploaded_files.extend(google_drive_files)
+            uploaded_files.extend(file for file in google_drive_files if FileFormat.is_supported(file.name))
 
         return uploaded_files, upload_expander
 
@@ -0,0 +1,90 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+"""
+
+import time
+import random
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, Sequence, Tuple
+
+from ainfer.metrics import span
+
+LOGGER = logging.getLogger(__name__)
+EMBED_BATCH_MAX_TEXTS = 96  # the limit of a single Cohere embed request
+EMBED_BATCH_MAX_CHARACTERS = 200_000
+EMBED_MAX_WORKERS = 8
+EMBED_MAX_RETRIES = 4
+EMBED_RETRY_BASE_DELAY = 1.0  # seconds, doubled on every retry
+
+Batch = Tuple[str, ...]
+
+
+class EmbeddingError(Exception):
+    def __init__(self, failed_texts_count: int):
+        super().__init__(f'Failed embedding {failed_texts_count} texts.')
+        self.failed_texts_count = failed_texts_count
+
+
+def embed_texts(texts: Sequence[str], backend, model: str, on_batch_embedded: Callable[[Batch, List], None]):
+    """
+    Embeds the texts in size-bounded batches sent concurrently.
+    `on_batch_embedded` is called from the calling thread as soon as a batch finishes, so completed work survives
+    a failure of other batches. Raises EmbeddingError once all batches are done if some of them failed.
+    """
+    batches = split_into_batches(texts)
+    if not batches:
+        return
+
+    failed_texts_count = 0
+    with span('embed'), ThreadPoolExecutor(max_workers=min(EMBED_MAX_WORKERS, len(batches))) as executor:
+        futures = {executor.submit(_embed_batch_with_retries, batch, backend, model): batch for batch in batches}
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                embeddings = future.result()
+            except Exception as e:
+                LOGGER.warning('Failed embedding a batch of %d texts: %s', len(batch), e)
+                failed_texts_count += len(batch)
+                continue
+            on_batch_embedded(batch, embeddings)
+
+    LOGGER.info('Embedded %d texts in %d batches.', len(texts) - failed_texts_count, len(batches))
+
+    if failed_texts_count:
+        raise EmbeddingError(failed_texts_count)
+
+
+def split_into_batches(texts: Sequence[str], max_texts: int = EMBED_BATCH_MAX_TEXTS,
+                       max_characters: int = EMBED_BATCH_MAX_CHARACTERS) -> List[Batch]:
+    batches, batch, batch_characters = [], [], 0
+    for text in texts:
+        if batch and (len(batch) >= max_texts or batch_characters + len(text) > max_characters):
+            batches.append(tuple(batch))
+            batch, batch_characters = [], 0
+        batch.append(text)
+        batch_characters += len(text)
+    if batch:
+        batches.append(tuple(batch))
+    return batches
+
+
+def _embed_batch_with_retries(batch: Batch, backend, model: str) -> List:
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        try:
+            return backend.embed(batch, model)
+        except Exception as e:
+            if attempt == EMBED_MAX_RETRIES or not _is_retryable(e):
+                raise
+            # exponential backoff with jitter, so that throttled batches do not retry in lockstep
+            delay = EMBED_RETRY_BASE_DELAY * 2 ** attempt * (1 + random.random())
+            LOGGER.info('Embedding a batch failed (%s), retrying in %.1f s.', e, delay)
+            time.sleep(delay)
+
+
+def _is_retryable(error: Exception) -> bool:
+    # backend errors carry the HTTP status, anything without one is a network failure worth retrying
+    http_status = getattr(error, 'http_status', None)
+    return http_status is None or http_status == 429 or http_status >= 500
@@ -0,0 +1,209 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+"""
+
+import os
+import logging
+import hashlib
+import threading
+from pathlib import Path
+from typing import NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ainfer.embeddings.store import get_embedding_store
+from ainfer.types.ranking import EmbeddingMatrix
+
+LOGGER = logging.getLogger(__name__)
+USE_IVF_INDEX = True
+IVF_MIN_PARAGRAPHS_COUNT = 20_000  # below that a brute-force scan is as fast and exact
+IVF_LIST_COUNT = 256
+IVF_PROBE_COUNT = 16
+IVF_TRAINING_SAMPLE_SIZE = 64 * IVF_LIST_COUNT
+IVF_TRAINING_ITERATIONS = 8
+IVF_FOLDER_NAME = 'ivf'
+CENTROIDS_SUFFIX = '.centroids.npy'
+LISTS_SUFFIX = '.lists.npy'
+
+_CODEBOOK_LOCK = threading.Lock()
+
+
+class IVFFileLists(NamedTuple):
+    """The vectors of one file grouped by the lists of a codebook."""
+    vectors: np.ndarray  # (paragraphs, dimensions), normalized and sorted by list
+    lists_offsets: np.ndarray  # vectors of list i are vectors[lists_offsets[i]:lists_offsets[i + 1]]
+    rows: np.ndarray  # row of every vector in the file's embeddings
+
+    @property
+    def nbytes(self) -> int:
+        return self.vectors.nbytes + self.rows.nbytes
+
+    @staticmethod
+    def build(centroids: np.ndarray, file_embeddings: EmbeddingMatrix, lists: np.ndarray) -> 'IVFFileLists':
+        rows = np.argsort(lists.astype(np.int64), kind='stable')
+        lists_offsets = np.searchsorted(lists[rows], np.arange(len(centroids) + 1))
+        return IVFFileLists(vectors=_normalized(file_embeddings)[rows], lists_offsets=lists_offsets, rows=rows)
+
+
+class IVFIndex:
+    """
+    Inverted file index: normalized vectors are grouped by their nearest centroid and
+    a query only scans the lists of its `probe_count` nearest centroids.
+    Every file keeps its own part of the lists, so a file added to the searched ones adds its vectors to the lists,
+    the parts of the other files are reused as they are.
+    """
+
+    def __init__(self, centroids: np.ndarray, files_lists: Sequence[IVFFileLists]):
+        self.centroids = centroids  # (lists, dimensions), normalized
+        self.files_lists = files_lists
+        # files' rows start at these rows of the concatenation of the files' embeddings
+        self.files_offsets = np.cumsum([0] + [len(file_lists.rows) for file_lists in files_lists])
+
+    def __len__(self) -> int:
+        return int(self.files_offsets[-1])
+
+    @property
+    def nbytes(self) -> int:
+        return sum(file_lists.nbytes for file_lists in self.files_lists)
+
+    def search(self, embedding: np.ndarray, top_k: int, probe_count: int = IVF_PROBE_COUNT) -> Tuple[np.ndarray, np.ndarray]:
+        """Approximate top_k rows and their cosine similarities, sorted by similarity in ascending order."""
+        embedding = embedding / max(np.linalg.norm(embedding), np.finfo(np.float32).tiny)
+        probed_lists = top_k_indices(self.centroids @ embedding, probe_count)
+        rows, similarities = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.float32)]
+        for file_offset, file_lists in zip(self.files_offsets, self.files_lists):
+            if not len(file_lists.rows):
+                continue
+            candidates = np.concatenate([np.arange(file_lists.lists_offsets[i], file_lists.lists_offsets[i + 1])
+                                         for i in probed_lists])
+            rows.append(file_lists.rows[candidates] + file_offset)
+            similarities.append(file_lists.vectors[candidates] @ embedding)
+        rows, similarities = np.concatenate(rows), np.concatenate(similarities)
+        top_candidates = top_k_indices(similarities, top_k)
+        return rows[top_candidates], similarities[top_candidates]
+
+
+def search_embeddings(files_embeddings: Sequence[EmbeddingMatrix], embedding: np.ndarray, top_k: int,
+                      index: Optional[IVFIndex] = None) -> Tuple[np.ndarray, np.ndarray]:
+    if index is not None:
+        return index.search(embedding, top_k)
+    return brute_force_search(files_embeddings, embedding, top_k)
+
+
+def brute_force_search(files_embeddings: Sequence[EmbeddingMatrix], embedding: np.ndarray,
+                       top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Exact top_k rows and their cosine similarities, sorted by similarity in ascending order."""
+    similarities = np.concatenate([np.empty(0, dtype=np.float32)] + [
+        file_embeddings.similarities(embedding) for file_embeddings in files_embeddings])
+    rows = top_k_indices(similarities, top_k)
+    return rows, similarities[rows]
+
+
+def top_k_indices(values: np.ndarray, top_k: int) -> np.ndarray:
+    # argpartition selects the candidates in linear time, only they get sorted
+    if top_k < len(values):
+        candidates = np.argpartition(values, len(values) - top_k)[len(values) - top_k:]
+    else:
+        candidates = np.arange(len(values))
+    return candidates[np.argsort(values[candidates], kind='stable')]
+
+
+def build_ivf_index(files_digests: Sequence[str], files_embeddings: Sequence[EmbeddingMatrix], model: str,
+                    files_lists: Optional[Sequence[Optional[IVFFileLists]]] = None) -> Optional[IVFIndex]:
+    """
+    Builds the index over the files, None means that a brute-force search should be used.
+    Lists of the files indexed before are reused as given, only the other files get theirs built.
+    """
+    if not USE_IVF_INDEX or sum(map(len, files_embeddings)) < IVF_MIN_PARAGRAPHS_COUNT:
+        return None
+
+    codebook, centroids = _get_or_train_codebook(files_embeddings, model)
+    files_lists = [
+        file_lists if file_lists is not None else IVFFileLists.build(
+            centroids, file_embeddings, _get_or_assign_lists(codebook, centroids, digest, file_embeddings, model))
+        for digest, file_embeddings, file_lists in zip(
+            files_digests, files_embeddings, files_lists or [None] * len(files_digests))]
+    return IVFIndex(centroids, files_lists)
+
+
+def index_file_embeddings(digest: str, file_embeddings: EmbeddingMatrix, model: str):
+    # Assigns a newly embedded file to the lists of the model's codebook, so that the index grows file by file.
+    # Until there is a codebook nothing is done, files are assigned once it gets trained.
+    codebook = _load_codebook(model)
+    if codebook is not None:
+        _get_or_assign_lists(*codebook, digest, file_embeddings, model)
+
+
+def train_centroids(vectors: np.ndarray, list_count: int = IVF_LIST_COUNT,
+                    iterations: int = IVF_TRAINING_ITERATIONS, seed: int = 0) -> np.ndarray:
+    """Spherical k-means over the normalized vectors."""
+    random = np.random.default_rng(seed)
+    centroids = vectors[random.choice(len(vectors), size=list_count, replace=len(vectors) < list_count)]
+    for _ in range(iterations):
+        lists = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, lists, vectors)
+        empty_lists = np.flatnonzero(np.bincount(lists, minlength=list_count) == 0)
+        sums[empty_lists] = vectors[random.choice(len(vectors), size=len(empty_lists))]
+        centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), np.finfo(np.float32).tiny)
+    return centroids.astype(np.float32)
+
+
+def _get_or_train_codebook(files_embeddings: Sequence[EmbeddingMatrix], model: str) -> Tuple[str, np.ndarray]:
+    with _CODEBOOK_LOCK:
+        codebook = _load_codebook(model)
+        if codebook is not None:
+            return codebook
+
+        vectors = np.concatenate([_normalized(file_embeddings) for file_embeddings in files_embeddings
+                                  if len(file_embeddings)])
+        sample = vectors[np.random.default_rng(0).permutation(len(vectors))[:IVF_TRAINING_SAMPLE_SIZE]]
+        LOGGER.info('Training the index codebook for model %s on %d vectors.', model, len(sample))
+        centroids = train_centroids(sample)
+
+        codebook = hashlib.sha256(centroids.tobytes()).hexdigest()[:16]
+        _save_atomically(_ivf_folder(model) / (codebook + CENTROIDS_SUFFIX), centroids)
+        # another process may have trained a codebook at the same time, all of them agree on the first one
+        return _load_codebook(model)
+
+
+def _load_codebook(model: str) -> Optional[Tuple[str, np.ndarray]]:
+    codebooks = sorted(_ivf_folder(model).glob('*' + CENTROIDS_SUFFIX))
+    if not codebooks:
+        return None
+    return codebooks[0].name[:-len(CENTROIDS_SUFFIX)], np.load(codebooks[0])
+
+
+def _get_or_assign_lists(codebook: str, centroids: np.ndarray, digest: str, file_embeddings: EmbeddingMatrix,
+                         model: str) -> np.ndarray:
+    lists_path = _ivf_folder(model) / codebook / (digest + LISTS_SUFFIX)
+    if lists_path.exists():
+        return np.load(lists_path)
+
+    lists = np.argmax(_normalized(file_embeddings) @ centroids.T, axis=1).astype(np.int16) \
+        if len(file_embeddings) else np.empty(0, dtype=np.int16)
+    lists_path.parent.mkdir(parents=True, exist_ok=True)
+    _save_atomically(lists_path, lists)
+    return lists
+
+
+def _normalized(file_embeddings: EmbeddingMatrix) -> np.ndarray:
+    if not len(file_embeddings):
+        return file_embeddings.vectors
+    return file_embeddings.vectors / np.maximum(file_embeddings.norms, np.finfo(np.float32).tiny)[:, None]
+
+
+def _ivf_folder(model: str) -> Path:
+    # the index lives next to the embeddings of the model
+    folder = get_embedding_store(model).folder / IVF_FOLDER_NAME
+    folder.mkdir(parents=True, exist_ok=True)
+    return folder
+
+
+def _save_atomically(path: Path, array: np.ndarray):
+    temporary_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    with temporary_path.open('wb') as f:
+        np.save(f, array)
+    os.replace(temporary_path, path)
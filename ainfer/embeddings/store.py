@@ -0,0 +1,127 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+"""
+
+import os
+import fcntl
+import logging
+import hashlib
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_EMBEDDINGS_FOLDER = '/tmp/ainfer/embeddings'
+KEY_SIZE = 16
+KEYS_FILE = 'keys.bin'
+VECTORS_FILE = 'vectors.f32'
+DIMENSION_FILE = 'dimension'
+LOCK_FILE = '.lock'
+
+
+@lru_cache(maxsize=None)
+def get_embedding_store(model: str) -> 'EmbeddingStore':
+    # one store per model and process, the log on disk is shared between processes
+    return EmbeddingStore(Path(DEFAULT_EMBEDDINGS_FOLDER) / _model_folder_name(model), model)
+
+
+class EmbeddingStore:
+    """
+    Append-only embedding log keyed by the hash of the embedding model and the text.
+    Vectors are appended as float32 rows to `vectors.f32`, then their keys to `keys.bin`, so a row counts as written
+    once its key is, and the keys file is the persisted index of the rows. Writers of all processes take a file lock,
+    readers memory-map the written rows without locking and read only the keys appended since they last looked.
+    """
+
+    def __init__(self, folder: Path, model: str):
+        self.folder = folder
+        self.model = model
+        self._index: Dict[bytes, int] = {}  # key -> row
+        self._rows = 0  # rows in the index
+        self._dimension: Optional[int] = None
+        self._vectors: Optional[np.ndarray] = None  # memory-mapped rows of the index
+        self._lock = threading.Lock()
+        self.folder.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self._refresh()
+
+    def __len__(self) -> int:
+        return self._rows
+
+    def get(self, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        keys = [self._key(text) for text in texts]
+        with self._lock:
+            if any(key not in self._index for key in keys):
+                self._refresh()  # other processes may have appended rows, costs a stat if they have not
+            rows = [self._index.get(key) for key in keys]
+            return [None if row is None else self._vectors[row] for row in rows]
+
+    def put(self, texts: Sequence[str], embeddings: Sequence[Sequence[float]]):
+        with self._lock, self._locked_files():
+            self._refresh()  # rows appended by other processes are not appended again
+            new_rows = {}
+            for text, embedding in zip(texts, embeddings):
+                key = self._key(text)
+                if key not in self._index:
+                    new_rows[key] = embedding
+            if not new_rows:
+                return
+            self._append(list(new_rows), np.asarray(list(new_rows.values()), dtype=np.float32))
+            self._refresh()
+            LOGGER.info('Stored %d new embeddings for model %s.', len(new_rows), self.model)
+
+    def _key(self, text: str) -> bytes:
+        return hashlib.blake2b(f'{self.model}\0{text}'.encode(), digest_size=KEY_SIZE).digest()
+
+    def _append(self, keys: List[bytes], vectors: np.ndarray):
+        # called with the files locked and the index refreshed, so the index covers every written row
+        if self._dimension is None:
+            self._dimension = vectors.shape[1]
+            (self.folder / DIMENSION_FILE).write_text(str(self._dimension))
+        if vectors.shape[1] != self._dimension:
+            raise ValueError(f'Embeddings of {vectors.shape[1]} dimensions for a store of {self._dimension}.')
+        # a writer that died midway may have left a part of a row or of a key, it is cut off first
+        with (self.folder / VECTORS_FILE).open('ab') as f:
+            f.truncate(self._rows * self._dimension * vectors.itemsize)
+            f.write(vectors.tobytes())
+        with (self.folder / KEYS_FILE).open('ab') as f:
+            f.truncate(self._rows * KEY_SIZE)
+            f.write(b''.join(keys))
+
+    def _refresh(self):
+        try:
+            rows = os.stat(self.folder / KEYS_FILE).st_size // KEY_SIZE
+        except FileNotFoundError:
+            return
+        if rows <= self._rows:
+            return
+        if self._dimension is None:
+            self._dimension = int((self.folder / DIMENSION_FILE).read_text())
+        with (self.folder / KEYS_FILE).open('rb') as f:
+            f.seek(self._rows * KEY_SIZE)
+            keys = f.read((rows - self._rows) * KEY_SIZE)
+        for row in range(len(keys) // KEY_SIZE):
+            self._index.setdefault(keys[row * KEY_SIZE:(row + 1) * KEY_SIZE], self._rows + row)
+        self._rows = rows
+        # one map of all the rows, vectors returned before keep the earlier map alive as long as they need it
+        self._vectors = np.memmap(self.folder / VECTORS_FILE, dtype=np.float32, mode='r',
+                                  shape=(rows, self._dimension))
+
+    @contextmanager
+    def _locked_files(self):
+        with (self.folder / LOCK_FILE).open('a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _model_folder_name(model: str) -> str:
+    return ''.join(c if c.isalnum() or c in '-_.' else '_' for c in model)
@@ -7,35 +7,111 @@
 import base64
 import time
 import os
+import uuid
 import logging
-from operator import itemgetter
-from typing import Sequence
+from typing import Iterator, List, Optional, Sequence, Tuple
 
-import cohere
 import streamlit as st
-import numpy as np
 from PIL import Image
 
 from ainfer.client import file_uploader, file_memorizer
 from ainfer.memory import memorize_files
+from ainfer.types.files import File
 from ainfer.types.ranking import RankedParagraph
 from ainfer.files.highlight_file import highlight_paragraphs_in_files
 from ainfer.files.display_file import display_files
 from ainfer.files.parse_file import parse_files
-from ainfer.ranking import rank_paragraphs, choose_paragraphs_for_context
-from ainfer.cache import cache_files, get_files_from_cache, cache_answer, get_answer_from_cache, build_answer_cache_key, answer_is_cached
+from ainfer.jobs import IngestionJob, JobStatus, get_job_queue
+from ainfer.ranking import (
+    RETRIEVAL_MODE,
+    rank_paragraphs,
+    rank_embedded_paragraphs,
+    rank_lexical_paragraphs,
+    choose_paragraphs_for_context,
+    get_ready_embeddings)
+from ainfer.cache import cache_files, get_files_from_cache, get_parsed_file_embeddings_from_cache, cache_answer, get_answer_from_cache, build_answer_cache_key, build_summary_cache_key, get_answer_cache_stats
+from ainfer.embeddings.store import get_embedding_store
+from ainfer.generation import build_context, create_response, get_summary
+from ainfer.metrics import span, profile, write_metrics
+from ainfer.backends.base import Backend
+from ainfer.backends.factory import get_backend
 
 logging.basicConfig(level=logging.INFO)
 
 LOGGER = logging.getLogger(__name__)
-
-
-def build_context(paragraphs_for_context: Sequence[RankedParagraph]) -> str:
-    LOGGER.info(f"Number of paragraphs chosen for context: {len(paragraphs_for_context)}")
-
-    LOGGER.info(f"Similarities of chosen paragraphs: {list(map(itemgetter(-1), paragraphs_for_context))}")
-
-    return "\n".join(map(itemgetter(1), paragraphs_for_context))
+STREAMING_ANSWER_MIN_PAGES = 10  # questions asked during ingestion get answered once that many pages are searchable
+STREAM_RENDER_INTERVAL = 0.05  # seconds between redraws of a generating answer
+JOB_POLL_INTERVAL = 0.2  # seconds between checks of the ingestion jobs
+STOPPED_INGESTIONS_KEY = '_stopped_ingestions'
+SESSION_ID_KEY = '_session_id'
+
+
+def get_session_id() -> str:
+    # jobs are shared between sessions, each session holds the jobs of its files by this id
+    return st.session_state.setdefault(SESSION_ID_KEY, uuid.uuid4().hex)
+
+
+def submit_ingestion_jobs(files: Sequence[File], backend: Backend, model: str,
+                          retry: bool = False) -> List[IngestionJob]:
+    # files the user stopped ingesting are left to ranking, which parses and embeds them when asked,
+    # the failed ones are ingested again only when the user retries them
+    stopped_digests = st.session_state.setdefault(STOPPED_INGESTIONS_KEY, set())
+    return get_job_queue().submit_files([file for file in files if file.digest not in stopped_digests], backend, model,
+                                        get_session_id(), retry)
+
+
+def stop_ingestion_jobs(jobs: Sequence[IngestionJob]):
+    # the session lets go of the jobs, those that other sessions hold go on
+    for job in jobs:
+        get_job_queue().detach(job, get_session_id())
+        st.session_state[STOPPED_INGESTIONS_KEY].add(job.digest)
+
+
+def get_ingestion_fraction(jobs: Sequence[IngestionJob]) -> float:
+    return sum(job.fraction for job in jobs) / len(jobs) if jobs else 1.0
+
+
+def rank_ingested_paragraphs(files: Sequence[File], jobs: Sequence[IngestionJob], question: str, backend: Backend,
+                             model: str, bar) -> Tuple[Optional[Sequence[RankedParagraph]], bool]:
+    # Polls the jobs until enough pages are searchable or all of them are finished.
+    # Returns the ranked paragraphs and whether they were ranked against all the files.
+    while not all(job.status.finished() for job in jobs):
+        bar.progress(get_ingestion_fraction(jobs))
+        ingested_pages = sum(job.ingested_pages for job in jobs)
+        if ingested_pages >= STREAMING_ANSWER_MIN_PAGES:
+            parsed_files, files_embeddings = [], []
+            for job in jobs:
+                if job.status is JobStatus.DONE:
+                    # a finished job keeps no file data, the file and its embeddings are in the caches
+                    job_parsed_files = parse_files([next(file for file in files if file.digest == job.digest)])
+                    job_files_embeddings = [get_parsed_file_embeddings_from_cache(job_parsed_files[0], model)]
+                else:
+                    job_parsed_files, job_files_embeddings = job.snapshot()
+                parsed_files.extend(job_parsed_files)
+                files_embeddings.extend(job_files_embeddings)
+            if parsed_files:
+                break
+        time.sleep(JOB_POLL_INTERVAL)
+    else:
+        # files of the finished jobs are in the parse cache, the stopped ones get parsed now,
+        # the failed ones are left out, they failed parsing or are not files of the format their name says
+        bar.progress(1.0)
+        failed_digests = {job.digest for job in jobs if job.status is JobStatus.FAILED}
+        files = [file for file in files if file.digest not in failed_digests]
+        if not files:
+            return None, True
+        return rank_paragraphs(parse_files(files), question, backend, model=model), True
+
+    LOGGER.info(f'Answering from the first {ingested_pages} pages.')
+    # the pages that are parsed but not embedded yet are searched lexically, without waiting for their embeddings
+    embeddings = None
+    if RETRIEVAL_MODE != 'lexical' and all(file_embeddings is not None for file_embeddings in files_embeddings):
+        embeddings = get_ready_embeddings([], question, backend, model=model)
+    if embeddings is None:
+        return rank_lexical_paragraphs(parsed_files, question), False
+    _, question_embedding = embeddings
+    return rank_embedded_paragraphs(parsed_files, files_embeddings, question_embedding,
+                                    question=question if RETRIEVAL_MODE == 'hybrid' else None), False
 
 
 def trim_stop_sequences(s, stop_sequences):
@@ -63,64 +139,19 @@ def get_img_with_href(local_img_path, target_url, align):
     return html_code
 
 
-def create_response(question, context, co, model, chat_history=""):
-    prompt = (
-        f'Read the paragraphs from the context below and answer the question, if the question cannot be answered based on the context alone, write "sorry i had trouble answering this question, based on the provided information \n'
-        f"\n"
-        f"Context:\n"
-        f"{ context }\n"
-        f"\n"
-        f"Question: { question }\n"
-        "Answer:")
-    stop_sequences = []
-
-    num_generations = 2
-    prompt = "".join(co.tokenize(text=prompt).token_strings[-1900:])
-    
-    LOGGER.info(f'Generating response for the question: "{question}".')
-
-    prediction = co.generate(
-        model=model,
-        prompt=prompt,
-        max_tokens=500,
-        temperature=0.3,
-        stop_sequences=stop_sequences,
-        num_generations=num_generations,
-        return_likelihoods="GENERATION")
-
-    generations = prediction.generations
-
-    LOGGER.info('Generated response. Doing some post-processing.')
-
-    return generations[np.argmax(map(lambda g: g.likelihood, generations))].text.strip()
-
-
-def get_summary(context, co, model):
-    prompt = (
-        f'Read the paragraph below and summarize it in a few sentences, if the context can not be summarized, write "Sorry, I could not come up with a good summary \n'
-        f"\n"
-        f"Paragraph:\n"
-        f"{ context }\n"
-        f"\n"
-        "Summary:")
-
-    num_generations = 2
-    prompt = "".join(co.tokenize(text=prompt).token_strings[-1900:])
-
-    stop_sequences = []
-
-    prediction = co.generate(
-        model=model,
-        prompt=prompt,
-        max_tokens=100,
-        temperature=0.3,
-        stop_sequences=stop_sequences,
-        num_generations=num_generations,
-        return_likelihoods="GENERATION")
-
-    generations = prediction.generations
-
-    return generations[np.argmax(map(lambda g: g.likelihood, generations))].text.strip()
+def render_stream(window, label: str, chunks: Iterator[str]) -> str:
+    # Redraws the window with the text generated so far, no more often than STREAM_RENDER_INTERVAL.
+    # Returns the whole generated text.
+    text = ''
+    rendered_at = 0.0
+    for chunk in chunks:
+        text += chunk
+        if time.monotonic() - rendered_at >= STREAM_RENDER_INTERVAL:
+            window.text_area(label=label, value=text.lstrip(), height=200, disabled=False)
+            rendered_at = time.monotonic()
+    text = text.strip()
+    window.text_area(label=label, value=text, height=200, disabled=False)
+    return text
 
 def main():
 
@@ -130,7 +161,9 @@ def main():
 
     st.sidebar.image(app_logo)
     cohere_api_key = ""
-    co = cohere.Client(cohere_api_key)
+    backend = get_backend(api_key=cohere_api_key)
+    # read once, so that the whole run embeds with one model even if the backend falls back meanwhile
+    embedding_model = backend.embedding_model
 
     st.markdown("""
     <style>
@@ -165,65 +198,74 @@ def main():
 
     raw_files = uploaded_files + list(filter(lambda mf: mf.name not in uploaded_file_names, memorized_files))
 
-    raw_file_names = [file.name for file in raw_files]
-
     cache_files(raw_files)
     display_file_index = None
 
-    if raw_files:
-        parsed_files = parse_files(raw_files)
+    # ingestion runs in the background and goes on across reruns, the script only polls the jobs
+    jobs = submit_ingestion_jobs(raw_files, backend, embedding_model)
+    if any(not job.status.finished() for job in jobs) and upload_expander.button(
+            "Stop ingesting", help="Files that are not ingested yet get parsed when you ask a question"):
+        stop_ingestion_jobs(jobs)
+    failed_jobs = [job for job in jobs if job.status is JobStatus.FAILED]
+    for job in failed_jobs:
+        st.sidebar.warning(f"Failed to process {job.name}: {job.error}", icon="⚠️")
+    if failed_jobs and st.sidebar.button("Retry failed files"):
+        jobs = submit_ingestion_jobs(raw_files, backend, embedding_model, retry=True)
+    if jobs:
+        ingestion_bar = upload_expander.progress(get_ingestion_fraction(jobs))
 
     with st.sidebar.expander("Get Answer"):
         question = st.text_input('Ask a question:', placeholder=None, key="input")
 
-        answer = None
-        answer_key = build_answer_cache_key(raw_file_names, question)
-        if question and answer_is_cached(answer_key):
-            LOGGER.info(answer_key)
-            answer = get_answer_from_cache(answer_key)
-
-        if question and raw_files and not answer:
+        if question and raw_files:
             bar = st.progress(0.0)
 
-            ranked_paragraphs = rank_paragraphs(
-                parsed_files, question, co, model="multilingual-22-12")
-            
-            if ranked_paragraphs is not None:
+            with span('retrieve'):
+                ranked_paragraphs, ingestion_complete = rank_ingested_paragraphs(
+                    raw_files, jobs, question, backend, embedding_model, bar)
+
+            if ranked_paragraphs:
                 try:
                     display_file_index = uploaded_file_names.index(ranked_paragraphs[-1][0].name)
                 except ValueError:
                     display_file_index = None
 
-                paragraphs_for_context = choose_paragraphs_for_context(ranked_paragraphs)
+                with span('choose'):
+                    paragraphs_for_context = choose_paragraphs_for_context(ranked_paragraphs, model=embedding_model)
 
-                cache_files(raw_files) # to clear existing highlight
-                cache_files(highlight_paragraphs_in_files(paragraphs_for_context))
+                with span('highlight'):
+                    cache_files(highlight_paragraphs_in_files(paragraphs_for_context))
 
-                context = build_context(paragraphs_for_context)
+                # answers are shared between sessions by context, the question embedding is in the store already.
+                # An answer based on the first pages only is neither looked up nor stored, the cached answers were
+                # given with all the files searched, and the paragraphs of the first pages can make the same context.
+                answer_key = build_answer_cache_key(paragraphs_for_context)
+                question_embedding, = get_embedding_store(embedding_model).get((question,))
+                answer = None
+                if ingestion_complete:
+                    answer = get_answer_from_cache(answer_key, question, question_embedding, embedding_model,
+                                                   backend.generation_model)
 
-                bar.progress(0.5)
-                
-                answer = create_response(question=question, context=context, co=co, model='command-medium-nightly')
-                cache_answer(answer_key, answer)
-                
-                bar.progress(1.0)
-            
                 response_window = st.empty()
-                for i in range(len(answer) + 1):
-                    response_window.text_area(label="Response: ", value=answer[0:i], height=200, disabled=False)
-                    time.sleep(0.02)
-                bar.empty()
-            else:
-                bar.empty()
-        # TODO: if the answer is present, but the user checked use_memory, then we should recompute the answer
-        elif question and raw_files and answer:
-            response_window = st.empty()
-            response_window.text_area(label="Response: ", value=answer, height=200, disabled=False)
+                if answer is not None:
+                    LOGGER.info(f'Answer cache: {get_answer_cache_stats()}.')
+                    response_window.text_area(label="Response: ", value=answer, height=200, disabled=False)
+                else:
+                    context = build_context(paragraphs_for_context)
+
+                    with span('generate'):
+                        generation = create_response(
+                            question=question, paragraphs_for_context=context, backend=backend,
+                            model=backend.generation_model)
+                        answer = render_stream(response_window, "Response: ", generation)
+                    if ingestion_complete:
+                        cache_answer(answer_key, question, answer, question_embedding, embedding_model,
+                                     generation.model)
+            bar.empty()
 
     if uploaded_files:
         display_files(get_files_from_cache(uploaded_file_names), display_file_index=display_file_index)
 
-
     with st.sidebar.expander("Get Summary"):
         summary_col1, summary_col2 = st.columns(2)
         
@@ -234,24 +276,30 @@ def main():
         
         text_to_sum = text_to_sum_window.text_area(label="Text for Summary: ", value="", height=200, disabled=False, key="sum_window")
 
-        summary = None
-        summary_key = build_answer_cache_key(raw_file_names, 'summary')
-        if summary_request and answer_is_cached(summary_key):
-            summary = get_answer_from_cache(summary_key)
+        summary_key = build_summary_cache_key(text_to_sum)
 
         if summary_request:
             with summary_col2:
                 st.write("")
             sum_bar = summary_col2.progress(0.0)
-            summary = get_summary(context=text_to_sum, co=co, model='command-medium-nightly')
-            cache_answer(summary_key, summary)
-            summary.replace("\n", " ")
+            summary = get_answer_from_cache(summary_key, text_to_sum, generation_model=backend.generation_model)
+            if summary is None:
+                with span('summarize'):
+                    generation = get_summary(context=text_to_sum, backend=backend, model=backend.generation_model)
+                    summary = render_stream(summary_window, "Summary: ", generation)
+                cache_answer(summary_key, text_to_sum, summary, generation_model=generation.model)
+            else:
+                summary_window.text_area(label="Summary: ", value=summary, height=200, disabled=False)
             sum_bar.progress(1.0)
-            for i in range(len(summary) + 1):
-                summary_window.text_area(label="Summary: ", value=summary[0:i], height=200, disabled=False)
-                time.sleep(0.02)
             sum_bar.empty()
 
+    # the bar follows the jobs until they finish, a rerun stops the polling but not the jobs
+    while any(not job.status.finished() for job in jobs):
+        ingestion_bar.progress(get_ingestion_fraction(jobs))
+        time.sleep(JOB_POLL_INTERVAL)
+    if jobs:
+        ingestion_bar.empty()
+
   #  st.sidebar.write("\n")
   #  column1, column2 = st.sidebar.columns(2)
 
@@ -262,4 +310,9 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    # every interaction reruns the script, so a run is a request
+    with profile('request'):
+        try:
+            main()
+        finally:
+            write_metrics()
@@ -4,12 +4,19 @@
  Date: Feb 03 2023
 """
 
+import math
 import base64
+from itertools import islice
 from typing import List
 import streamlit as st
 
+from ainfer.files.parsers import DOCX_PARAGRAPHS_PER_PAGE, DocxParser
+from ainfer.files.serve_file import serve_file
 from ainfer.types.files import File, FileFormat
 
+DISPLAY_TEXT_MAX_BYTES = 256 * 1024  # only the beginning of larger text files is displayed inline
+DISPLAY_DOCX_MAX_PARAGRAPHS = 500
+
 
 def display_files(files: List[File], display_file_index):
     files_count = len(files)
@@ -28,22 +35,47 @@ def display_files(files: List[File], display_file_index):
 
 def display_file(file: File):
     if FileFormat.is_pdf(file.name):
-        _display_pdf(file.value)
+        _display_pdf(file)
     elif FileFormat.is_docx(file.name):
         _display_docx(file)
     else:
         _display_txt(file)
 
 
-def _display_pdf(value: bytes):
+def _display_pdf(file: File):
+    # with a file server configured, the browser fetches the file from it and keeps it, the page only carries its URL
+    url = serve_file(file)
+    if url is None:
+        _display_pdf_inline(file.value)
+        return
+    pdf_display = f'<object data="{url}" width="100%" height="1000" type="application/pdf"></object>'
+    st.markdown(pdf_display, unsafe_allow_html=True)
+
+
+def _display_pdf_inline(value: bytes):
     base64_pdf = base64.b64encode(value).decode('utf-8')
     pdf_display = f'<object data="data:application/pdf;base64,{base64_pdf}" width="100%" height="1000" type="application/pdf"></object>'
     st.markdown(pdf_display, unsafe_allow_html=True)
 
 
-def _display_docx(value: bytes):
-    raise NotImplementedError
+def _display_docx(file: File):
+    # browsers do not display Word documents, their text is shown instead, read in a single pass
+    # that stops after the displayed paragraphs and the one telling whether there are more
+    pages_count = math.ceil((DISPLAY_DOCX_MAX_PARAGRAPHS + 1) / DOCX_PARAGRAPHS_PER_PAGE)
+    paragraphs = [paragraph for paragraph, _ in islice(
+        DocxParser().iter_paragraphs(file.value, 0, pages_count), DISPLAY_DOCX_MAX_PARAGRAPHS + 1)]
+    st.text_area(label=file.name, value='\n\n'.join(paragraphs[:DISPLAY_DOCX_MAX_PARAGRAPHS]), height=1000,
+                 disabled=True)
+    if len(paragraphs) > DISPLAY_DOCX_MAX_PARAGRAPHS:
+        st.caption(f'Only the first {DISPLAY_DOCX_MAX_PARAGRAPHS} paragraphs are displayed.')
 
 
-def _display_txt(value: bytes):
-    raise NotImplementedError
+def _display_txt(file: File):
+    # with a file server configured, the browser streams the file from it, however large it is
+    url = serve_file(file)
+    if url is not None:
+        st.markdown(f'<iframe src="{url}" width="100%" height="1000"></iframe>', unsafe_allow_html=True)
+        return
+    st.text(file.value[:DISPLAY_TEXT_MAX_BYTES].decode(errors='replace'))
+    if len(file.value) > DISPLAY_TEXT_MAX_BYTES:
+        st.caption(f'Only the first {DISPLAY_TEXT_MAX_BYTES // 1024} KB of the file are displayed.')
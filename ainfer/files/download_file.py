@@ -4,28 +4,177 @@
  Date: Feb 03 2023
 """
 
+import os
+import re
+import hashlib
 import logging
-from typing import Sequence
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional, Sequence, Tuple
 from pathlib import Path
+from urllib.parse import urljoin
 import streamlit as st
 
 from cachetools.func import ttl_cache
 import gdown
+import requests
 
+from ainfer.metrics import count_cache_requests, timed_remote_call
 from ainfer.types.files import File
 
 LOGGER = logging.getLogger(__name__)
 DEFAULT_DOWNLOAD_FOLDER = '/tmp/ainfer/google_drive_files'
+GOOGLE_DRIVE_API_URL = os.environ.get('AINFER_GOOGLE_DRIVE_API_URL', 'https://www.googleapis.com/drive/v3/')
+GOOGLE_DRIVE_API_KEY = os.environ.get('AINFER_GOOGLE_DRIVE_API_KEY')  # without a key folders are fetched by gdown
+GOOGLE_DRIVE_FOLDER_TTL = 60  # seconds a folder listing is reused for, every interaction reruns the script
+GDOWN_FOLDER_TTL = 10 * 60  # seconds, gdown downloads the whole folder again as it keeps no files
+DOWNLOAD_MAX_WORKERS = 8
+DOWNLOAD_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+DOWNLOAD_TIMEOUT = 60  # seconds
+FOLDER_ID_PATTERN = re.compile(r'folders/([\w-]+)')
+GOOGLE_APPS_MIME_TYPE_PREFIX = 'application/vnd.google-apps.'  # folders and documents, they have no file content
+GOOGLE_DRIVE_FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+
+class DriveFile(NamedTuple):
+    id: str
+    name: str
+    revision: str  # changes whenever the content does
 
 
 # test url: https://drive.google.com/drive/folders/1k2vQrn3WbvIBH4klVSzxAKRTKgYZvpwa?usp=share_link
-@ttl_cache(ttl=60 * 10)  # cache for 10 minutes, not to download the same files over and over again
 def download_files_from_google_drive(google_drive_folder_url: str) -> Sequence[File]:
-    # gdown saves files from the Google Drive folder to the local DEFAULT_DOWNLOAD_FOLDER folder
-    # and returns complete paths to the downloaded files like DEFAULT_DOWNLOAD_FOLDER/somefile.pdf
+    """
+    Files of the folder and its subfolders are downloaded concurrently and kept on disk by Drive file id and revision,
+    so that only new and changed files are fetched again, even after a restart.
+    """
     warning_message = 'Please, provide a valid Google Drive folder link or check permissions'
+    if GOOGLE_DRIVE_API_KEY is None:
+        return _download_files_with_gdown(google_drive_folder_url, warning_message)
+    return _download_files_with_api(google_drive_folder_url, warning_message)
+
+
+@ttl_cache(ttl=GOOGLE_DRIVE_FOLDER_TTL)
+def _download_files_with_api(google_drive_folder_url: str, warning_message: str) -> Sequence[File]:
+    folder_id = FOLDER_ID_PATTERN.search(google_drive_folder_url)
+    try:
+        drive_files = _list_folder(folder_id.group(1) if folder_id else google_drive_folder_url)
+    except Exception as e:
+        LOGGER.warning(f'Failed listing Google Drive folder: {google_drive_folder_url}. {e}')
+        st.sidebar.warning(warning_message, icon="⚠️")
+        return ()
+
+    folder = Path(DEFAULT_DOWNLOAD_FOLDER)
+    folder.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max(1, min(DOWNLOAD_MAX_WORKERS, len(drive_files)))) as executor:
+        files = list(executor.map(_get_file, drive_files))
+    _evict_files(folder, DOWNLOAD_CACHE_MAX_BYTES)
+
+    return tuple(file for file in files if file is not None)
+
+
+def _list_folder(folder_id: str) -> List[DriveFile]:
+    # files of the subfolders too, as gdown downloads them, each folder is listed once
+    drive_files, folder_ids, listed_folder_ids = [], [folder_id], set()
+    while folder_ids:
+        folder_id = folder_ids.pop()
+        if folder_id in listed_folder_ids:
+            continue
+        listed_folder_ids.add(folder_id)
+        folder_files, subfolder_ids = _list_folder_children(folder_id)
+        drive_files.extend(folder_files)
+        folder_ids.extend(reversed(subfolder_ids))
+    return drive_files
+
+
+@timed_remote_call('google_drive_list')
+def _list_folder_children(folder_id: str) -> Tuple[List[DriveFile], List[str]]:
+    drive_files, subfolder_ids, page_token = [], [], None
+    while True:
+        params = {
+            'q': f"'{folder_id}' in parents and trashed = false",
+            'fields': 'nextPageToken, files(id, name, mimeType, md5Checksum, headRevisionId, modifiedTime)',
+            'pageSize': 1000,
+            'key': GOOGLE_DRIVE_API_KEY,
+        }
+        if page_token:
+            params['pageToken'] = page_token
+        response = requests.get(urljoin(GOOGLE_DRIVE_API_URL, 'files'), params=params, timeout=DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+        listing = response.json()
+
+        for drive_file in listing.get('files', []):
+            if drive_file.get('mimeType') == GOOGLE_DRIVE_FOLDER_MIME_TYPE:
+                subfolder_ids.append(drive_file['id'])
+                continue
+            if drive_file.get('mimeType', '').startswith(GOOGLE_APPS_MIME_TYPE_PREFIX):
+                continue
+            revision = drive_file.get('md5Checksum') or drive_file.get('headRevisionId') or drive_file['modifiedTime']
+            drive_files.append(DriveFile(id=drive_file['id'], name=drive_file['name'], revision=revision))
+
+        page_token = listing.get('nextPageToken')
+        if not page_token:
+            return drive_files, subfolder_ids
+
+
+def _get_file(drive_file: DriveFile) -> Optional[File]:
+    path = _get_cached_path(drive_file)
+    count_cache_requests('google_drive', hit=path.exists())
+    try:
+        if path.exists():
+            os.utime(path)  # eviction goes by the last use
+        else:
+            _download_file(drive_file, path)
+        return File(name=drive_file.name, value=path.read_bytes())
+    except Exception as e:
+        LOGGER.warning(f'Failed downloading file: {drive_file.name}. {e}')
+        return None
+
+
+@timed_remote_call('google_drive_download')
+def _download_file(drive_file: DriveFile, path: Path):
+    response = requests.get(urljoin(GOOGLE_DRIVE_API_URL, f'files/{drive_file.id}'),
+                            params={'alt': 'media', 'key': GOOGLE_DRIVE_API_KEY}, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
+
+    # written next to the cached files and renamed, so that a reader never sees a partial file
+    fd, temporary_path = tempfile.mkstemp(dir=path.parent, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+        os.replace(temporary_path, path)
+    finally:
+        Path(temporary_path).unlink(missing_ok=True)
+
+    # the earlier revisions of the file are of no use anymore
+    for stale_path in path.parent.glob(f'{drive_file.id}.*.bin'):
+        if stale_path != path:
+            stale_path.unlink(missing_ok=True)
+
+
+def _get_cached_path(drive_file: DriveFile) -> Path:
+    revision = hashlib.blake2b(drive_file.revision.encode(), digest_size=16).hexdigest()
+    return Path(DEFAULT_DOWNLOAD_FOLDER) / f'{drive_file.id}.{revision}.bin'
+
+
+def _evict_files(folder: Path, max_bytes: int):
+    # the least recently used files go first
+    paths = sorted(folder.glob('*.bin'), key=lambda path: path.stat().st_mtime, reverse=True)
+    total_bytes = 0
+    for path in paths:
+        total_bytes += path.stat().st_size
+        if total_bytes > max_bytes:
+            path.unlink(missing_ok=True)
+
+
+@ttl_cache(ttl=GDOWN_FOLDER_TTL)
+def _download_files_with_gdown(google_drive_folder_url: str, warning_message: str) -> Sequence[File]:
+    # gdown saves files from the Google Drive folder to the local DEFAULT_DOWNLOAD_FOLDER/gdown folder
+    # and returns complete paths to the downloaded files like DEFAULT_DOWNLOAD_FOLDER/gdown/somefile.pdf
     try:
-        filenames = gdown.download_folder(google_drive_folder_url, output=DEFAULT_DOWNLOAD_FOLDER, quiet=True)
+        filenames = gdown.download_folder(
+            google_drive_folder_url, output=os.path.join(DEFAULT_DOWNLOAD_FOLDER, 'gdown'), quiet=True)
         if type(filenames) is not list:
             st.sidebar.warning(warning_message, icon="⚠️")
             filenames = []
@@ -33,17 +182,17 @@ def download_files_from_google_drive(google_drive_folder_url: str) -> Sequence[F
         st.sidebar.warning(warning_message, icon="⚠️")
         filenames = []
 
-    # TODO: read files in parallel
-    return tuple(_pop_file(filename) for filename in filenames)
+    with ThreadPoolExecutor(max_workers=max(1, min(DOWNLOAD_MAX_WORKERS, len(filenames)))) as executor:
+        return tuple(file for file in executor.map(_pop_file, filenames) if file is not None)
 
 
 # read file and delete it
-def _pop_file(filename: str) -> File:
+def _pop_file(filename: str) -> Optional[File]:
     file_path = Path(filename)
     try:
         file_contents = file_path.open('rb').read()
         return File(name=file_path.name, value=file_contents)
     except Exception as e:
-        LOGGER.warning(f'Failed reading file: {file_path}.', e)
+        LOGGER.warning(f'Failed reading file: {file_path}. {e}')
     finally:
         file_path.unlink(missing_ok=True)  # delete the file after reading it
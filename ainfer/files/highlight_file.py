@@ -4,48 +4,112 @@
  Date: Feb 03 2023
 """
 
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
 import fitz
-from typing import List
-from collections import defaultdict
+from typing import List, Sequence, Tuple
 from collections.abc import Mapping
 
+from ainfer.cache import cache_highlights, get_highlights_from_cache
 from ainfer.types.ranking import RankedParagraph
-from ainfer.types.files import ParsedFile
+from ainfer.types.files import ParsedFile, FileFormat
 
 STROKE_COLOR = (0, 0, 0)
 HIGHLIGHT_COLOR = (0, 45 / 255, 1)
+DEFAULT_HIGHLIGHT_FOLDER = '/tmp/ainfer/highlights'
+HIGHLIGHT_SOURCES_MAX_BYTES = 2 * 1024 * 1024 * 1024
 
 
 def highlight_paragraphs_in_files(ranked_paragraphs: List[RankedParagraph]) -> List[ParsedFile]:
-    return [_highlight_paragraphs_in_file(file, paragraphs) for file, paragraphs in _group_paragraphs_by_file(ranked_paragraphs).items()]
+    return [_highlight_paragraphs_in_file(file, paragraphs_indices) for file, paragraphs_indices in _group_paragraphs_by_file(ranked_paragraphs).values()]
+
+
+def _highlight_paragraphs_in_file(file: ParsedFile, paragraphs_indices: List[int]) -> ParsedFile:
+    if not FileFormat.is_pdf(file.name):
+        return file  # only PDFs are displayed with the paragraphs highlighted
+
+    paragraphs_indices = tuple(sorted(set(paragraphs_indices)))
+    coords = [file.paragraphs_coordinates[paragraph_index] for paragraph_index in paragraphs_indices]
+
+    # Highlights are kept as an incremental PDF update appended to the original bytes,
+    # only the highlighted pages are rewritten and the same highlights are drawn only once
+    highlights = get_highlights_from_cache(file, paragraphs_indices)
+    if highlights is None:
+        highlights = _draw_highlights(file, coords)
+        cache_highlights(file, paragraphs_indices, highlights)
+    original_length, update = highlights
+
+    return ParsedFile(
+        name=file.name,
+        value=file.value[:original_length] + update if original_length < len(file.value) else file.value + update,
+        paragraphs=file.paragraphs,
+        paragraphs_coordinates=file.paragraphs_coordinates)
+
+
+def _draw_highlights(file: ParsedFile, coords: Sequence[Tuple]) -> Tuple[int, bytes]:
+    # Returns how many bytes of the original file the highlighted one starts with and the bytes that follow them
+    folder = Path(DEFAULT_HIGHLIGHT_FOLDER)
+    folder.mkdir(parents=True, exist_ok=True)
+    fd, highlighted_path = tempfile.mkstemp(dir=folder, suffix='.pdf')
+    os.close(fd)
+    try:
+        shutil.copyfile(_get_source_path(file), highlighted_path)
+        with fitz.open(highlighted_path) as pdf:
+            _draw_highlights_in_pdf(pdf, coords)
+            if not pdf.can_save_incrementally():
+                return 0, pdf.write()
+            pdf.saveIncr()
+        with open(highlighted_path, 'rb') as highlighted_file:
+            highlighted_file.seek(len(file.value))
+            return len(file.value), highlighted_file.read()
+    finally:
+        os.unlink(highlighted_path)
+
 
+def _draw_highlights_in_pdf(pdf: fitz.Document, coords: Sequence[Tuple]):
+    for paragraph_coords in coords:
 
-def _highlight_paragraphs_in_file(file: ParsedFile, paragraphs: List[str]) -> ParsedFile:
+        poycoords = [(paragraph_coords[0], paragraph_coords[1]), (paragraph_coords[2], paragraph_coords[1]),
+                     (paragraph_coords[2], paragraph_coords[3]), (paragraph_coords[0], paragraph_coords[3])]
 
-    coords = (file.paragraphs_coordinates[file.paragraphs.index(p)] for p in paragraphs)
+        page = pdf[paragraph_coords[-1]] # last coordinate is the page number
 
-    with fitz.open(stream=file.value) as pdf:
-        for paragraph_coords in coords:
+        shape = page.new_shape()
+        shape.drawPolyline(poycoords)
+        shape.finish(color=STROKE_COLOR, fill=HIGHLIGHT_COLOR, stroke_opacity=0.15, fill_opacity=0.15)
+        shape.commit()
 
-            poycoords = [(paragraph_coords[0], paragraph_coords[1]), (paragraph_coords[2], paragraph_coords[1]),
-                         (paragraph_coords[2], paragraph_coords[3]), (paragraph_coords[0], paragraph_coords[3])]
 
-            page = pdf[paragraph_coords[-1]] # last coordinate is the page number
+def _get_source_path(file: ParsedFile) -> Path:
+    # incremental updates need the original file on disk, it is written once per file content
+    source_folder = Path(DEFAULT_HIGHLIGHT_FOLDER) / 'sources'
+    source_path = source_folder / f'{file.digest}.pdf'
+    if not source_path.exists():
+        source_folder.mkdir(parents=True, exist_ok=True)
+        _evict_sources(source_folder, HIGHLIGHT_SOURCES_MAX_BYTES - len(file.value))
+        fd, temporary_path = tempfile.mkstemp(dir=source_folder)
+        with os.fdopen(fd, 'wb') as source_file:
+            source_file.write(file.value)
+        os.replace(temporary_path, source_path)
+    return source_path
 
-            shape = page.new_shape()
-            shape.drawPolyline(poycoords)
-            shape.finish(color=STROKE_COLOR, fill=HIGHLIGHT_COLOR, stroke_opacity=0.15, fill_opacity=0.15)
-            shape.commit()
 
-        return ParsedFile(
-            name=file.name,
-            value=pdf.write(),
-            paragraphs=file.paragraphs,
-            paragraphs_coordinates=file.paragraphs_coordinates)
+def _evict_sources(source_folder: Path, max_bytes: int):
+    # the least recently used sources go first
+    sources = sorted(source_folder.glob('*.pdf'), key=lambda path: path.stat().st_atime, reverse=True)
+    total_bytes = 0
+    for source_path in sources:
+        total_bytes += source_path.stat().st_size
+        if total_bytes > max_bytes:
+            source_path.unlink(missing_ok=True)
 
 
-def _group_paragraphs_by_file(ranked_paragraphs: List[RankedParagraph]) -> Mapping[ParsedFile, List[str]]:
-    groups = defaultdict(list)
-    for file, paragraph, _ in ranked_paragraphs:
-        groups[file].append(paragraph)
+def _group_paragraphs_by_file(ranked_paragraphs: List[RankedParagraph]) -> Mapping[int, Tuple[ParsedFile, List[int]]]:
+    # files are grouped by their index, hashing a file would hash all of its contents
+    groups = {}
+    for file, _, (file_index, paragraph_index), _ in ranked_paragraphs:
+        groups.setdefault(file_index, (file, []))[1].append(paragraph_index)
     return groups
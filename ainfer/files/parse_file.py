@@ -4,51 +4,285 @@
  Date: Feb 03 2023
 """
 
-from typing import Iterable, List, Tuple
+import os
+import logging
+import tempfile
+import multiprocessing
+import threading
+from collections import Counter, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Executor, ProcessPoolExecutor, wait
+from itertools import chain, islice
+from operator import itemgetter
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
 
-import fitz
+from cachetools import LRUCache
 
-from ainfer.types.files import File, ParsedFile, FileFormat
+from ainfer.cache import (
+    cache_parsed_paragraphs,
+    get_parsed_paragraphs_from_cache,
+    cache_parsed_page,
+    get_parsed_page_from_cache)
+from ainfer.files.parsers import get_parser
+from ainfer.lexical.bm25 import BM25Index
+from ainfer.metrics import span
+from ainfer.types.files import File, ParsedFile
 
+LOGGER = logging.getLogger(__name__)
+PARSE_WORKERS = int(os.environ.get('AINFER_PARSE_WORKERS', os.cpu_count() or 1))
+PAGES_PER_PARSE_TASK = 50  # larger files are split into page ranges parsed by different workers
+PARSE_TASKS_IN_FLIGHT_PER_WORKER = 2  # tasks reach the pool a few at a time, in priority order
+PARSE_FOLDER = '/tmp/ainfer/parse'  # files are written here once for the workers to read their page ranges from
 
-def parse_files(files: Iterable[File]) -> List[ParsedFile]:
-    return [parse_file(file) for file in files]
+_EXECUTOR: Optional[ProcessPoolExecutor] = None
+_EXECUTOR_WORKERS = 0
+_EXECUTOR_LOCK = threading.Lock()
+# pages counts by the file content hash, counting the pages of a DOCX file takes a pass over it
+_PAGES_COUNTS = LRUCache(maxsize=4096)
+_PAGES_COUNTS_LOCK = threading.Lock()
+
+ParagraphData = Tuple[Tuple[str, ...], Tuple[Tuple[float, float, float, float, int], ...]]
+
+
+class ParsedPages(NamedTuple):
+    file_index: int
+    first_page: int  # ranges of a file come in priority order, not in page order
+    pages_count: int  # number of pages in this range
+    paragraphs: Tuple[str, ...]
+    paragraphs_coordinates: Tuple[Tuple[float, float, float, float, int], ...]
+    parsed_file: Optional[ParsedFile]  # set on the last range of the file, when the whole file is parsed
+
+
+def parse_files(files: Iterable[File], workers: int = PARSE_WORKERS) -> List[ParsedFile]:
+    files = list(files)
+    parsed_files = [None] * len(files)
+    for parsed_pages in iter_parsed_pages(files, workers):
+        if parsed_pages.parsed_file is not None:
+            parsed_files[parsed_pages.file_index] = parsed_pages.parsed_file
+    return parsed_files
 
 
 def parse_file(file: File) -> ParsedFile:
-    if FileFormat.is_pdf(file.name):
-        return _parse_pdf(file)
-    if FileFormat.is_docx(file.name):
-        return _parse_docx(file)
-    return _parse_txt(file)
-
-
-def _parse_pdf(file: File) -> ParsedFile:
-    with fitz.open(stream=file.value) as pdf:
-        paragraphs = tuple(paragraph for paragraph, _ in _get_paragraph_data_from_pdf(pdf))
-        paragraphs_coordinates = tuple(coordinates for _, coordinates in _get_paragraph_data_from_pdf(pdf))
-        return ParsedFile(
-            name=file.name,
-            value=file.value,
-            paragraphs=paragraphs,
-            paragraphs_coordinates=paragraphs_coordinates)
-
-
-def _get_paragraph_data_from_pdf(pdf: fitz.Document) -> Iterable[Tuple]:
-    previous_block_id = 0
-    for page_number, page in enumerate(pdf):
-        for block in page.get_text('blocks'):
-            if block[6] == 0:  # We only take the text
-                # Compare the block number
-                if previous_block_id != block[5]:
-                    paragraph = block[4].replace('\n', ' ')
-                    paragraphs_coordinates = (block[0], block[1], block[2], block[3], page_number)
-                    yield paragraph, paragraphs_coordinates
-
-
-def _parse_docx(file: File) -> ParsedFile:
-    raise NotImplementedError
-
-
-def _parse_txt(file: File) -> ParsedFile:
-    raise NotImplementedError
+    return parse_files((file,), workers=1)[0]
+
+
+def count_pages(files: Sequence[File]) -> List[int]:
+    return [_count_pages(file) for file in files]
+
+
+def iter_parsed_pages(files: Sequence[File], workers: int = PARSE_WORKERS,
+                      pages_per_task: int = PAGES_PER_PARSE_TASK) -> Iterator[ParsedPages]:
+    """
+    Yields page ranges of the files, each as soon as it is parsed, not necessarily in the order they were submitted. Files found in the parse cache come as a single
+    range. Page ranges of the other files are parsed by a process pool in the background, the first range and the
+    ranges with the abstract, introduction or conclusion of every file first, the rest in page order. Ranges are
+    submitted to the pool in that order as workers free up, so the first ones are not queued behind the rest. Pages are
+    cached one by one as they are parsed, and each file gets cached in page order once its last range is parsed.
+    """
+    parsed_files = [_get_parsed_file_from_cache(file) for file in files]
+
+    tasks = [(file_index, task) for file_index, (file, parsed_file) in enumerate(zip(files, parsed_files))
+             if parsed_file is None for task in _split_into_tasks(file, pages_per_task)]
+    files_priority_pages = {file_index: _get_priority_pages(files[file_index])
+                            for file_index in {file_index for file_index, (_, first_page, _) in tasks if first_page}}
+    tasks.sort(key=lambda indexed_task: _get_task_priority(indexed_task, files_priority_pages))
+    # ranges with every page in the page cache are not parsed again
+    cached_results = [_get_task_from_cache(task) for _, task in tasks]
+    tasks_to_run = [task for (_, task), cached_result in zip(tasks, cached_results) if cached_result is None]
+    files_paths = {}
+    if workers > 1 and len(tasks_to_run) > 1:
+        # workers get the path of the file and their pages, instead of a copy of the file per range
+        LOGGER.info('Parsing %d page ranges with %d workers.', len(tasks_to_run), workers)
+        files_paths = _write_files({file.digest: file for file, _, _ in tasks_to_run}.values())
+        results = _iter_pool_results(
+            _get_executor(workers), [(file.name, files_paths[file.digest], first_page, last_page)
+                                     for file, first_page, last_page in tasks_to_run],
+            workers * PARSE_TASKS_IN_FLIGHT_PER_WORKER)
+    else:
+        results = enumerate(map(_run_task, tasks_to_run))
+
+    try:
+        for file_index, parsed_file in enumerate(parsed_files):
+            if parsed_file is not None:
+                yield ParsedPages(file_index, 0, _count_pages(parsed_file), parsed_file.paragraphs,
+                                  parsed_file.paragraphs_coordinates, parsed_file)
+        yield from _merge_results(files, tasks, cached_results, iter(results))
+    finally:
+        _remove_files(files_paths.values())
+
+
+def _merge_results(files, tasks, cached_results: Sequence[Optional[ParagraphData]],
+                   results: Iterator[Tuple[int, ParagraphData]]) -> Iterator[ParsedPages]:
+    # Ranges found in the page cache come first, the parsed ones as soon as they are done, whatever their order.
+    # Results are numbered by their position among the tasks that were run, every file gets its page ranges merged
+    # in page order once all of them are in.
+    positions_to_run = [position for position, cached_result in enumerate(cached_results) if cached_result is None]
+    results = chain(((position, cached_result) for position, cached_result in enumerate(cached_results)
+                     if cached_result is not None),
+                    ((positions_to_run[result_index], result) for result_index, result in results))
+    files_ranges = defaultdict(list)
+    remaining_tasks_counts = Counter(file_index for file_index, _ in tasks)
+    while True:
+        # the span covers the wait for the workers, not the time the caller spends on the yielded ranges
+        with span('parse'):
+            position, result = next(results, (None, None))
+            if position is None:
+                return
+            file_index, (file, first_page, last_page) = tasks[position]
+            paragraphs, paragraphs_coordinates = result
+            if cached_results[position] is None:
+                _cache_task((file, first_page, last_page), paragraphs, paragraphs_coordinates)
+            files_ranges[file_index].append((first_page, paragraphs, paragraphs_coordinates))
+            remaining_tasks_counts[file_index] -= 1
+
+            parsed_file = None
+            if not remaining_tasks_counts[file_index]:
+                ranges = sorted(files_ranges.pop(file_index), key=itemgetter(0))
+                parsed_file = _build_parsed_file(file, tuple(chain.from_iterable(map(itemgetter(1), ranges))),
+                                                 tuple(chain.from_iterable(map(itemgetter(2), ranges))))
+
+        yield ParsedPages(file_index, first_page, last_page - first_page, paragraphs, paragraphs_coordinates, parsed_file)
+
+
+def _get_parsed_file_from_cache(file: File) -> Optional[ParsedFile]:
+    # Streamlit reruns the script on every interaction, unchanged files should cost a hash lookup only
+    parsed = get_parsed_paragraphs_from_cache(file)
+    return None if parsed is None else ParsedFile.from_file(file, *parsed)
+
+
+def _build_parsed_file(file: File, paragraphs, paragraphs_coordinates) -> ParsedFile:
+    parsed_file = ParsedFile.from_file(file, paragraphs, paragraphs_coordinates)
+    cache_parsed_paragraphs(parsed_file, BM25Index.build(parsed_file.paragraphs))
+    return parsed_file
+
+
+def _split_into_tasks(file: File, pages_per_task: int) -> List[Tuple]:
+    page_count = _count_pages(file)
+    if not get_parser(file.name).splittable:
+        return [(file, 0, page_count)]
+    return [(file, first_page, min(first_page + pages_per_task, page_count))
+            for first_page in range(0, page_count, pages_per_task)] or [(file, 0, 0)]
+
+
+def _get_task_priority(indexed_task: Tuple, files_priority_pages: Dict[int, Tuple[int, ...]]) -> Tuple[int, int, int]:
+    # the first range of every file goes first, it usually holds the title and the abstract,
+    # then the ranges with priority sections of every file, then the rest of the files in page order
+    file_index, (file, first_page, last_page) = indexed_task
+    if not first_page:
+        return 0, file_index, 0
+    if any(first_page <= page < last_page for page in files_priority_pages[file_index]):
+        return 1, file_index, first_page
+    return 2, file_index, first_page
+
+
+def _get_priority_pages(file: File) -> Tuple[int, ...]:
+    return get_parser(file.name).get_priority_pages(file.value)
+
+
+def _get_task_from_cache(task: Tuple) -> Optional[ParagraphData]:
+    # None unless every page of the range is cached
+    file, first_page, last_page = task
+    pages = []
+    for page in range(first_page, last_page):
+        parsed_page = get_parsed_page_from_cache(file, page)
+        if parsed_page is None:
+            return None
+        pages.append(parsed_page)
+    if not pages:
+        return None
+    return tuple(chain.from_iterable(map(itemgetter(0), pages))), tuple(chain.from_iterable(map(itemgetter(1), pages)))
+
+
+def _cache_task(task: Tuple, paragraphs: Tuple[str, ...], paragraphs_coordinates: Tuple):
+    # the last coordinate of a paragraph is its page number, pages without paragraphs are cached too
+    file, first_page, last_page = task
+    pages = {page: ([], []) for page in range(first_page, last_page)}
+    for paragraph, coordinates in zip(paragraphs, paragraphs_coordinates):
+        pages[coordinates[4]][0].append(paragraph)
+        pages[coordinates[4]][1].append(coordinates)
+    for page, (page_paragraphs, page_paragraphs_coordinates) in pages.items():
+        cache_parsed_page(file, page, tuple(page_paragraphs), tuple(page_paragraphs_coordinates))
+
+
+def _count_pages(file: File) -> int:
+    with _PAGES_COUNTS_LOCK:
+        pages_count = _PAGES_COUNTS.get(file.digest)
+    if pages_count is None:
+        pages_count = get_parser(file.name).count_pages(file.value)
+        with _PAGES_COUNTS_LOCK:
+            _PAGES_COUNTS[file.digest] = pages_count
+    return pages_count
+
+
+def _iter_pool_results(executor: Executor, file_tasks: Sequence[Tuple],
+                       in_flight_count: int) -> Iterator[Tuple[int, ParagraphData]]:
+    # Submits the tasks in their order, no more than in_flight_count at once, and yields the index of every task and
+    # its result as soon as it is done. A task is submitted once another one is done, so later ranges never delay
+    # the first ones and the tasks that are not submitted yet cost nothing if the caller stops early.
+    file_tasks = enumerate(file_tasks)
+    futures = {executor.submit(_run_file_task, file_task): task_index
+               for task_index, file_task in islice(file_tasks, in_flight_count)}
+    try:
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                task_index = futures.pop(future)
+                for next_task_index, file_task in islice(file_tasks, 1):
+                    futures[executor.submit(_run_file_task, file_task)] = next_task_index
+                yield task_index, future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def _run_task(task: Tuple) -> ParagraphData:
+    file, first_page, last_page = task
+    return _split_paragraph_data(get_parser(file.name).iter_paragraphs(file.value, first_page, last_page))
+
+
+def _run_file_task(file_task: Tuple) -> ParagraphData:
+    # run by the workers, which read only what the pages need from the file on disk
+    name, path, first_page, last_page = file_task
+    return _split_paragraph_data(get_parser(name).iter_file_paragraphs(path, first_page, last_page))
+
+
+def _split_paragraph_data(located_paragraphs: Iterator) -> ParagraphData:
+    paragraph_data = tuple(located_paragraphs)  # single pass over the pages
+    paragraphs = tuple(paragraph for paragraph, _ in paragraph_data)
+    paragraphs_coordinates = tuple(coordinates for _, coordinates in paragraph_data)
+    return paragraphs, paragraphs_coordinates
+
+
+def _write_files(files: Iterable[File]) -> Dict[str, str]:
+    # paths of the files by their content hash, every process writes its own copies
+    os.makedirs(PARSE_FOLDER, exist_ok=True)
+    files_paths = {}
+    for file in files:
+        descriptor, files_paths[file.digest] = tempfile.mkstemp(prefix=f'{file.digest}.', dir=PARSE_FOLDER)
+        with os.fdopen(descriptor, 'wb') as f:
+            f.write(file.value)
+    return files_paths
+
+
+def _remove_files(paths: Iterable[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            LOGGER.warning('Failed removing %s.', path)
+
+
+def _get_executor(workers: int) -> ProcessPoolExecutor:
+    # the pool outlives reruns, starting worker processes on every upload would eat the gain
+    global _EXECUTOR, _EXECUTOR_WORKERS
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None or _EXECUTOR_WORKERS != workers:
+            if _EXECUTOR is not None:
+                _EXECUTOR.shutdown(wait=False)
+            # Workers are forked from a server process without threads, forking this one with the locks that the
+            # Streamlit, ingestion, embedding and file server threads hold could leave a worker deadlocked.
+            # The server imports the parsing modules once, so that workers start without importing them again.
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload([__name__])
+            _EXECUTOR = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            _EXECUTOR_WORKERS = workers
+        return _EXECUTOR
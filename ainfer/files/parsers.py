@@ -0,0 +1,219 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+"""
+
+import io
+import os
+import re
+import math
+import mmap
+import zipfile
+from abc import ABC, abstractmethod
+from typing import Iterator, List, Tuple
+from xml.etree import ElementTree
+
+import fitz
+
+from ainfer.types.files import Coordinates, FileFormat
+
+# page ranges with these sections, taken from the outline of the PDF, are parsed right after the first range
+PRIORITY_SECTIONS_PATTERN = re.compile(r'abstract|summary|introduction|conclusion|discussion', re.IGNORECASE)
+TEXT_PAGE_BYTES = 4096  # a page of a text file, about a printed page, it ends at the first line end after that
+TEXT_PARAGRAPH_MAX_CHARACTERS = 1000  # text without blank lines, like logs, is cut into paragraphs at line ends
+TEXT_COUNT_CHUNK_BYTES = 1024 * 1024  # lines before a page range of a mapped text file are counted chunk by chunk
+DOCX_PARAGRAPHS_PER_PAGE = 30  # DOCX files have no pages until rendered
+DOCX_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+LocatedParagraph = Tuple[str, Coordinates]
+
+
+class Parser(ABC):
+    """
+    Parses a file format page range by page range, so that ranges can be parsed by different workers and a file
+    becomes searchable before it is parsed whole. Paragraphs are yielded one by one, along with their coordinates:
+    the bounding box on the page and the page number. Formats without layout put their line or paragraph numbers
+    in place of the box.
+    """
+
+    splittable = True  # whether a page range can be parsed without parsing the pages before it
+
+    @abstractmethod
+    def count_pages(self, value: bytes) -> int:
+        pass
+
+    def get_priority_pages(self, value: bytes) -> Tuple[int, ...]:
+        """Pages to parse before the others, found without parsing the file."""
+        return ()
+
+    @abstractmethod
+    def iter_paragraphs(self, value: bytes, first_page: int, last_page: int) -> Iterator[LocatedParagraph]:
+        pass
+
+    def iter_file_paragraphs(self, path: str, first_page: int, last_page: int) -> Iterator[LocatedParagraph]:
+        """Paragraphs of the page range of a file on disk, the way parse workers read the ranges they are given."""
+        with open(path, 'rb') as f:
+            value = f.read()
+        yield from self.iter_paragraphs(value, first_page, last_page)
+
+
+def get_parser(filename: str) -> Parser:
+    # files of unknown formats are read as text, the way they are displayed
+    if FileFormat.is_pdf(filename):
+        return PdfParser()
+    if FileFormat.is_docx(filename):
+        return DocxParser()
+    return TextParser()
+
+
+class PdfParser(Parser):
+
+    def count_pages(self, value: bytes) -> int:
+        with fitz.open(stream=value) as pdf:
+            return pdf.page_count
+
+    def get_priority_pages(self, value: bytes) -> Tuple[int, ...]:
+        # Pages of the priority sections by the outline, a cheap page index read without extracting any text.
+        # An entry spans the pages up to the next entry, documents without an outline have no priority pages.
+        with fitz.open(stream=value) as pdf:
+            toc = [(title, page - 1) for _, title, page in pdf.get_toc(simple=True) if page > 0]
+            page_count = pdf.page_count
+        pages = []
+        for entry_index, (title, page) in enumerate(toc):
+            if PRIORITY_SECTIONS_PATTERN.search(title):
+                next_page = next((next_page for _, next_page in toc[entry_index + 1:] if next_page > page), page + 1)
+                pages.extend(range(page, min(next_page, page_count)))
+        return tuple(pages)
+
+    def iter_paragraphs(self, value: bytes, first_page: int, last_page: int) -> Iterator[LocatedParagraph]:
+        with fitz.open(stream=value) as pdf:
+            yield from _iter_pdf_paragraphs(pdf, first_page, last_page)
+
+    def iter_file_paragraphs(self, path: str, first_page: int, last_page: int) -> Iterator[LocatedParagraph]:
+        # MuPDF reads the objects of the pages it extracts, not the whole file
+        with fitz.open(path) as pdf:
+            yield from _iter_pdf_paragraphs(pdf, first_page, last_page)
+
+
+def _iter_pdf_paragraphs(pdf, first_page: int, last_page: int) -> Iterator[LocatedParagraph]:
+        previous_block_id = 0
+        for page_number in range(first_page, last_page):
+            page = pdf[page_number]
+            for block in page.get_text('blocks'):
+                if block[6] == 0:  # We only take the text
+                    # Compare the block number
+                    if previous_block_id != block[5]:
+                        paragraph = block[4].replace('\n', ' ')
+                        paragraphs_coordinates = (block[0], block[1], block[2], block[3], page_number)
+                        yield paragraph, paragraphs_coordinates
+
+
+class TextParser(Parser):
+    """
+    Plain UTF-8 text, like logs or transcripts. Pages are cut at line ends, so only the lines of a page range are read,
+    one at a time. Paragraphs are separated by blank lines or cut once they get long, and never span pages.
+    Their boxes hold the first and the last line number: (0, first line, 0, last line + 1).
+    """
+
+    def count_pages(self, value: bytes) -> int:
+        return math.ceil(len(value) / TEXT_PAGE_BYTES)
+
+    def iter_paragraphs(self, value: bytes, first_page: int, last_page: int) -> Iterator[LocatedParagraph]:
+        return _iter_text_paragraphs(value, first_page, last_page)
+
+    def iter_file_paragraphs(self, path: str, first_page: int, last_page: int) -> Iterator[LocatedParagraph]:
+        # the file is mapped, the lines before the range are counted and only those of the range get decoded
+        if first_page >= last_page:
+            return
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as value:
+                yield from _iter_text_paragraphs(value, first_page, last_page)
+
+
+def _iter_text_paragraphs(value, first_page: int, last_page: int) -> Iterator[LocatedParagraph]:
+    # the value is bytes or a mapped file, both slice into bytes and find line ends
+    pages_starts = [_get_text_page_start(value, page) for page in range(first_page, last_page + 1)]
+    start, end = pages_starts[0], pages_starts[-1]
+    line_number = _count_lines(value, start)
+    lines = io.BytesIO(value[start:end])
+    for page_number, page_end in zip(range(first_page, last_page), pages_starts[1:]):
+        page_end -= start
+        paragraph_lines, paragraph_length, paragraph_first_line = [], 0, line_number
+        while lines.tell() < page_end:
+            line = lines.readline().decode(errors='replace').strip()
+            if line_number == 0:
+                line = line.lstrip('\ufeff')  # byte order mark
+            line_number += 1
+            if not line:
+                if paragraph_lines:
+                    yield ' '.join(paragraph_lines), (0, paragraph_first_line, 0, line_number - 1, page_number)
+                paragraph_lines, paragraph_length = [], 0
+                continue
+            if not paragraph_lines:
+                paragraph_first_line = line_number - 1
+            paragraph_lines.append(line)
+            paragraph_length += len(line) + 1
+            if paragraph_length >= TEXT_PARAGRAPH_MAX_CHARACTERS:
+                yield ' '.join(paragraph_lines), (0, paragraph_first_line, 0, line_number, page_number)
+                paragraph_lines, paragraph_length = [], 0
+        if paragraph_lines:
+            yield ' '.join(paragraph_lines), (0, paragraph_first_line, 0, line_number, page_number)
+
+
+def _count_lines(value, end: int) -> int:
+    # mapped files have no count, a chunk at a time is copied out
+    return sum(value[chunk_start:min(chunk_start + TEXT_COUNT_CHUNK_BYTES, end)].count(b'\n')
+               for chunk_start in range(0, end, TEXT_COUNT_CHUNK_BYTES))
+
+
+def _get_text_page_start(value: bytes, page: int) -> int:
+    # a page starts at the first line that starts in it, a line longer than a page leaves the next pages empty
+    if page == 0:
+        return 0
+    line_end = value.find(b'\n', page * TEXT_PAGE_BYTES - 1)
+    return len(value) if line_end < 0 else line_end + 1
+
+
+class DocxParser(Parser):
+    """
+    Word documents, read as a stream of XML events, so the document is never held in memory as a tree.
+    A page is DOCX_PARAGRAPHS_PER_PAGE paragraphs with text, their boxes hold the paragraph number:
+    (0, paragraph number, 0, paragraph number + 1). Pages are found by reading the document from its start,
+    so a document is parsed as a single range.
+    """
+
+    splittable = False
+
+    def count_pages(self, value: bytes) -> int:
+        paragraphs_count = sum(1 for _ in _iter_docx_paragraphs(value))
+        return math.ceil(paragraphs_count / DOCX_PARAGRAPHS_PER_PAGE)
+
+    def iter_paragraphs(self, part: bytes, first_page: int, last_page: int) -> Iterator[LocatedParagraph]:
+        first_paragraph, last_paragraph = first_page * DOCX_PARAGRAPHS_PER_PAGE, last_page * DOCX_PARAGRAPHS_PER_PAGE
+        for paragraph_number, paragraph in enumerate(_iter_docx_paragraphs(part)):
+            if paragraph_number >= last_paragraph:
+                return
+            if paragraph_number >= first_paragraph:
+                page_number = paragraph_number // DOCX_PARAGRAPHS_PER_PAGE
+                yield paragraph, (0, paragraph_number, 0, paragraph_number + 1, page_number)
+
+
+def _iter_docx_paragraphs(value: bytes) -> Iterator[str]:
+    # paragraphs with text in the document order, those of tables and text boxes included
+    with zipfile.ZipFile(io.BytesIO(value)) as docx, docx.open('word/document.xml') as document:
+        for _, element in ElementTree.iterparse(document):
+            if element.tag != f'{DOCX_NAMESPACE}p':
+                continue
+            texts: List[str] = []
+            for child in element.iter():
+                if child.tag == f'{DOCX_NAMESPACE}t' and child.text:
+                    texts.append(child.text)
+                elif child.tag in (f'{DOCX_NAMESPACE}tab', f'{DOCX_NAMESPACE}br'):
+                    texts.append(' ')
+            element.clear()  # paragraphs nested in text boxes are cleared before the paragraph holding them
+            paragraph = ''.join(texts).strip()
+            if paragraph:
+                yield paragraph
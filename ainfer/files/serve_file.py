@@ -0,0 +1,118 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+from typing import Optional, Tuple
+from urllib.parse import quote
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+
+from ainfer.memory import get_blob_store, get_session_files
+from ainfer.types.files import File, FileFormat
+
+LOGGER = logging.getLogger(__name__)
+FILE_SERVER_HOST = os.environ.get('AINFER_FILE_SERVER_HOST', '127.0.0.1')
+FILE_SERVER_PORT = int(os.environ.get('AINFER_FILE_SERVER_PORT', 8502))
+# The address browsers reach the server at, it differs from the bound one behind a proxy. There is no default,
+# as browsers of a remote or an https deployment cannot reach localhost, files are displayed inline unless it is set.
+FILE_SERVER_URL = os.environ.get('AINFER_FILE_SERVER_URL')
+FILE_SERVER_START_TIMEOUT = 5.0  # seconds
+SERVED_FILES_KEY = '_served_files'
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)')
+MEDIA_TYPES = {FileFormat.PDF: 'application/pdf', FileFormat.TXT: 'text/plain; charset=utf-8',
+               FileFormat.DOCX: 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'}
+
+_SERVER: Optional[uvicorn.Server] = None
+_SERVER_LOCK = threading.Lock()
+
+
+def serve_file(file: File) -> Optional[str]:
+    """
+    URL the file is served at, next to the Streamlit app. Files are addressed by their content hash, so browsers
+    keep them cached for good and fetch a file again only when it changes. None if the server is not configured
+    by AINFER_FILE_SERVER_URL or is not running.
+    """
+    if FILE_SERVER_URL is None or not start_file_server():
+        return None
+    # the session references the file, so that it stays in the blob store while the session can display it
+    get_session_files(SERVED_FILES_KEY).add(file)
+    return f'{FILE_SERVER_URL}/files/{file.digest}/{quote(file.name)}'
+
+
+def start_file_server() -> bool:
+    # once per process, a server that failed to start is not retried on every rerun
+    global _SERVER
+    with _SERVER_LOCK:
+        if _SERVER is None:
+            _SERVER = uvicorn.Server(uvicorn.Config(APP, host=FILE_SERVER_HOST, port=FILE_SERVER_PORT,
+                                                    log_level='warning'))
+            thread = threading.Thread(target=_SERVER.run, name='file-server', daemon=True)
+            thread.start()
+            deadline = time.monotonic() + FILE_SERVER_START_TIMEOUT
+            while not _SERVER.started and thread.is_alive() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            if _SERVER.started:
+                LOGGER.info(f'Serving files at {FILE_SERVER_URL}.')
+            else:
+                LOGGER.warning(f'Failed starting the file server on {FILE_SERVER_HOST}:{FILE_SERVER_PORT}.')
+        return _SERVER.started
+
+
+async def _get_file(request: Request) -> Response:
+    digest, name = request.path_params['digest'], request.path_params['name']
+    value = get_blob_store().get(digest)
+    if value is None:
+        return Response(status_code=404)
+
+    headers = {
+        'ETag': f'"{digest}"',
+        'Cache-Control': 'public, max-age=31536000, immutable',  # the URL changes with the content
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': f"inline; filename*=UTF-8''{quote(name)}",
+    }
+    if request.headers.get('if-none-match') == headers['ETag']:
+        return Response(status_code=304, headers=headers)
+
+    media_type = next((media_type for file_format, media_type in MEDIA_TYPES.items()
+                       if name.endswith(file_format.dotted())), 'application/octet-stream')
+
+    # ranges the server does not understand, like several ranges at once, are answered with the whole file
+    byte_range = request.headers.get('range')
+    if (byte_range is None or RANGE_PATTERN.fullmatch(byte_range.strip()) is None
+            or request.headers.get('if-range', headers['ETag']) != headers['ETag']):
+        return Response(value, media_type=media_type, headers=headers)
+
+    parsed_range = _parse_range(byte_range, len(value))
+    if parsed_range is None:
+        return Response(status_code=416, headers={**headers, 'Content-Range': f'bytes */{len(value)}'})
+    start, end = parsed_range
+    headers['Content-Range'] = f'bytes {start}-{end}/{len(value)}'
+    return Response(value[start:end + 1], status_code=206, media_type=media_type, headers=headers)
+
+
+def _parse_range(byte_range: str, size: int) -> Optional[Tuple[int, int]]:
+    # a single range, first and last byte inclusive, None if it is not satisfiable
+    first, last = RANGE_PATTERN.fullmatch(byte_range.strip()).groups()
+    if not first and not last:
+        return None
+    if not first:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        return None
+    return start, end
+
+
+APP = Starlette(routes=[Route('/files/{digest}/{name}', _get_file, methods=['GET', 'HEAD'])])
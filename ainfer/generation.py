@@ -0,0 +1,113 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+"""
+
+import json
+import time
+import logging
+from operator import itemgetter
+from typing import Iterator, Sequence
+from urllib.parse import urljoin
+
+import requests
+from cohere.error import CohereError
+
+from ainfer.backends.base import Generation
+from ainfer.metrics import REMOTE_CALL_SECONDS, observe, span
+from ainfer.prompt import build_answer_prompt, build_summary_prompt
+from ainfer.types.ranking import RankedParagraph
+
+LOGGER = logging.getLogger(__name__)
+GENERATE_ENDPOINT = 'generate'
+GENERATE_TIMEOUT = 60  # seconds to wait for the next chunk
+
+
+def build_context(paragraphs_for_context: Sequence[RankedParagraph]) -> Sequence[str]:
+    LOGGER.info(f"Number of paragraphs chosen for context: {len(paragraphs_for_context)}")
+
+    LOGGER.info(f"Similarities of chosen paragraphs: {list(map(itemgetter(-1), paragraphs_for_context))}")
+
+    return list(map(itemgetter(1), paragraphs_for_context))
+
+
+def create_response(question, paragraphs_for_context, backend, model, chat_history="") -> Generation:
+    with span('tokenize'):
+        prompt = build_answer_prompt(question, paragraphs_for_context)
+    stop_sequences = []
+
+    LOGGER.info(f'Generating response for the question: "{question}".')
+
+    return _as_generation(backend.generate(
+        model=model,
+        prompt=prompt,
+        max_tokens=500,
+        temperature=0.3,
+        stop_sequences=stop_sequences), model)
+
+
+def get_summary(context, backend, model) -> Generation:
+    with span('tokenize'):
+        prompt = build_summary_prompt(context)
+
+    stop_sequences = []
+
+    return _as_generation(backend.generate(
+        model=model,
+        prompt=prompt,
+        max_tokens=100,
+        temperature=0.3,
+        stop_sequences=stop_sequences), model)
+
+
+def _as_generation(chunks: Iterator[str], model: str) -> Generation:
+    # backends that never switch models yield the chunks only
+    return chunks if isinstance(chunks, Generation) else Generation(chunks, model)
+
+
+def stream_generation(co, model: str, prompt: str, max_tokens: int, temperature: float,
+                      stop_sequences: Sequence[str] = ()) -> Iterator[str]:
+    """
+    Yields the generated text chunk by chunk as the model produces it.
+    The installed Cohere SDK has no streaming support, so the API is called directly with the client's settings.
+    """
+    headers = {
+        'Authorization': f'BEARER {co.api_key}',
+        'Content-Type': 'application/json',
+        'Request-Source': co.request_source,
+    }
+    if co.cohere_version:
+        headers['Cohere-Version'] = co.cohere_version
+
+    body = {
+        'model': model,
+        'prompt': prompt,
+        'max_tokens': max_tokens,
+        'temperature': temperature,
+        'stop_sequences': list(stop_sequences),
+        'stream': True,
+    }
+
+    start = time.perf_counter()
+    with requests.post(urljoin(co.api_url, GENERATE_ENDPOINT), headers=headers, json=body, stream=True,
+                       timeout=GENERATE_TIMEOUT) as response:
+        if response.status_code != 200:
+            raise CohereError(message=response.text, http_status=response.status_code, headers=response.headers)
+
+        # every line is a JSON event, the last one marks the end of the generation
+        first_chunk = True
+        for line in response.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if 'message' in event:
+                raise CohereError(message=event['message'], http_status=response.status_code, headers=response.headers)
+            if event.get('is_finished'):
+                LOGGER.info('Generation finished: %s.', event.get('finish_reason'))
+                observe(REMOTE_CALL_SECONDS, time.perf_counter() - start, call='generate')
+                return
+            if first_chunk:
+                observe(REMOTE_CALL_SECONDS, time.perf_counter() - start, call='generate_first_chunk')
+                first_chunk = False
+            yield event.get('text', '')
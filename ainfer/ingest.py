@@ -0,0 +1,195 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+"""
+
+import bisect
+import logging
+import threading
+from typing import Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ainfer.cache import (
+    get_parsed_file_embeddings_from_cache,
+    cache_parsed_file_embeddings)
+from ainfer.embeddings.batching import embed_texts, EmbeddingError
+from ainfer.embeddings.index import index_file_embeddings
+from ainfer.embeddings.store import get_embedding_store
+from ainfer.files.parse_file import PARSE_WORKERS, count_pages, iter_parsed_pages
+from ainfer.types.files import File, ParsedFile
+from ainfer.types.ranking import EmbeddingMatrix
+
+LOGGER = logging.getLogger(__name__)
+PAGES_PER_INGESTION_WINDOW = 5
+
+
+class SearchableFiles:
+    """
+    Paragraphs of the ingested files that are already parsed, growing page range by page range. A range is searchable
+    lexically once it is parsed and by its embeddings once it is embedded. Ranges may come in any order and are kept
+    in page order. They are added by the ingesting thread while others take snapshots.
+    """
+
+    def __init__(self, files: Sequence[File]):
+        self._files = files
+        self._lock = threading.Lock()
+        # first page, paragraphs, their coordinates and embeddings of every range of every file, in page order,
+        # the embeddings are None until the range is embedded
+        self._ranges: List[List[Tuple[int, Sequence[str], Sequence, Optional[EmbeddingMatrix]]]] = [[] for _ in files]
+        self._complete_files: List[Optional[Tuple[ParsedFile, EmbeddingMatrix]]] = [None for _ in files]
+
+    def __len__(self) -> int:
+        paragraphs_count = 0
+        with self._lock:
+            for ranges, complete_file in zip(self._ranges, self._complete_files):
+                if complete_file is not None:
+                    paragraphs_count += len(complete_file[0].paragraphs)
+                else:
+                    paragraphs_count += sum(len(paragraphs) for _, paragraphs, _, _ in ranges)
+        return paragraphs_count
+
+    def add(self, file_index: int, first_page: int, paragraphs, paragraphs_coordinates,
+            embeddings: Optional[EmbeddingMatrix] = None):
+        with self._lock:
+            ranges = self._ranges[file_index]
+            range_index = bisect.bisect([range_first_page for range_first_page, _, _, _ in ranges], first_page)
+            ranges.insert(range_index, (first_page, paragraphs, paragraphs_coordinates, embeddings))
+
+    def embed(self, file_index: int, first_page: int, embeddings: EmbeddingMatrix):
+        with self._lock:
+            ranges = self._ranges[file_index]
+            range_index = bisect.bisect_left([range_first_page for range_first_page, _, _, _ in ranges], first_page)
+            _, paragraphs, paragraphs_coordinates, _ = ranges[range_index]
+            ranges[range_index] = (first_page, paragraphs, paragraphs_coordinates, embeddings)
+
+    def complete(self, file_index: int, parsed_file: ParsedFile, embeddings: EmbeddingMatrix):
+        with self._lock:
+            self._ranges[file_index] = []
+            self._complete_files[file_index] = (parsed_file, embeddings)
+
+    def file_embeddings(self, file_index: int) -> Optional[EmbeddingMatrix]:
+        with self._lock:
+            return self._file_embeddings(file_index)
+
+    def snapshot(self) -> Tuple[List[ParsedFile], List[Optional[EmbeddingMatrix]]]:
+        with self._lock:
+            return self._snapshot()
+
+    def _file_embeddings(self, file_index: int) -> Optional[EmbeddingMatrix]:
+        # None while a range of the file is not embedded
+        if any(range_embeddings is None for _, _, _, range_embeddings in self._ranges[file_index]):
+            return None
+        embeddings = [range_embeddings for _, _, _, range_embeddings in self._ranges[file_index]
+                      if len(range_embeddings)]
+        if len(embeddings) == 1:
+            return embeddings[0]
+        return EmbeddingMatrix.from_embeddings(
+            np.concatenate([range_embeddings.vectors for range_embeddings in embeddings]) if embeddings else [])
+
+    def _snapshot(self) -> Tuple[List[ParsedFile], List[Optional[EmbeddingMatrix]]]:
+        # files with at least one parsed paragraph and their embeddings, partial files hold the parsed pages only
+        parsed_files, files_embeddings = [], []
+        for file_index, file in enumerate(self._files):
+            ranges = self._ranges[file_index]
+            if self._complete_files[file_index] is not None:
+                parsed_file, embeddings = self._complete_files[file_index]
+            elif any(paragraphs for _, paragraphs, _, _ in ranges):
+                parsed_file = ParsedFile.from_file(
+                    file, [paragraph for _, paragraphs, _, _ in ranges for paragraph in paragraphs],
+                    [coordinates for _, _, paragraphs_coordinates, _ in ranges for coordinates in paragraphs_coordinates])
+                embeddings = self._file_embeddings(file_index)
+            else:
+                continue
+            parsed_files.append(parsed_file)
+            files_embeddings.append(embeddings)
+        return parsed_files, files_embeddings
+
+
+class IngestionProgress(NamedTuple):
+    ingested_pages: int
+    total_pages: int
+    searchable: SearchableFiles
+    parsed_files: List[Optional[ParsedFile]]  # fully parsed files, None for those still being parsed
+    embedding_failed: bool
+
+    @property
+    def fraction(self) -> float:
+        return self.ingested_pages / self.total_pages if self.total_pages else 1.0
+
+    @property
+    def complete(self) -> bool:
+        return all(parsed_file is not None for parsed_file in self.parsed_files) and not self.embedding_failed
+
+
+def ingest_files(files: Sequence[File], backend, model: str, workers: int = PARSE_WORKERS,
+                 pages_per_window: int = PAGES_PER_INGESTION_WINDOW) -> Iterator[IngestionProgress]:
+    """
+    Parses and embeds the files page range by page range, yielding the progress after every range.
+    Ranges get parsed by a process pool in the background while the earlier ones are embedded, so the first pages
+    become searchable long before the whole upload is ingested, lexically as soon as they are parsed. Once embedding
+    fails, no more requests are sent, the rest of the files is only parsed and the missing embeddings are left to
+    `ranking.get_embeddings`.
+    """
+    searchable = SearchableFiles(files)
+    parsed_files = [None] * len(files)
+    cached = False
+    embedding_failed = False
+    ingested_pages, total_pages = 0, sum(count_pages(files))
+
+    for parsed_pages in iter_parsed_pages(files, workers, pages_per_window):
+        file_index, parsed_file = parsed_pages.file_index, parsed_pages.parsed_file
+
+        file_embeddings = None if parsed_file is None else get_parsed_file_embeddings_from_cache(parsed_file, model)
+        cached = file_embeddings is not None
+        if cached:
+            searchable.complete(file_index, parsed_file, file_embeddings)
+        else:
+            searchable.add(file_index, parsed_pages.first_page, parsed_pages.paragraphs,
+                           parsed_pages.paragraphs_coordinates)
+            if not embedding_failed:
+                try:
+                    embeddings = _embed_paragraphs(parsed_pages.paragraphs, backend, model)
+                except EmbeddingError as e:
+                    LOGGER.warning('%s Embedding the rest of the files is left for later.', e)
+                    embedding_failed = True
+                else:
+                    searchable.embed(file_index, parsed_pages.first_page, embeddings)
+                    if parsed_file is not None:
+                        _complete_file(searchable, file_index, parsed_file, model)
+
+        parsed_files[file_index] = parsed_file or parsed_files[file_index]
+        ingested_pages += parsed_pages.pages_count
+        progress = IngestionProgress(ingested_pages, total_pages, searchable, parsed_files, embedding_failed)
+        # files ingested before come first and all at once, only the ranges that took some work are reported
+        if not cached:
+            yield progress
+
+    if cached:
+        yield progress
+
+
+def _complete_file(searchable: SearchableFiles, file_index: int, parsed_file: ParsedFile, model: str):
+    embeddings = searchable.file_embeddings(file_index)
+    cache_parsed_file_embeddings(parsed_file, model, embeddings)
+    index_file_embeddings(parsed_file.digest, embeddings, model)
+    searchable.complete(file_index, parsed_file, embeddings)
+    LOGGER.info('Ingested %s.', parsed_file.name)
+
+
+def _embed_paragraphs(paragraphs: Sequence[str], backend, model: str) -> EmbeddingMatrix:
+    embedding_store = get_embedding_store(model)
+    embeddings = embedding_store.get(paragraphs)
+    texts_without_embeddings = tuple(dict.fromkeys(
+        paragraph for paragraph, embedding in zip(paragraphs, embeddings) if embedding is None))
+
+    new_embeddings = {}
+
+    def on_batch_embedded(batch, batch_embeddings):
+        embedding_store.put(batch, batch_embeddings)
+        new_embeddings.update(zip(batch, batch_embeddings))
+
+    embed_texts(texts_without_embeddings, backend, model, on_batch_embedded)
+    return EmbeddingMatrix.from_embeddings([new_embeddings[paragraph] if embedding is None else embedding
+                                            for paragraph, embedding in zip(paragraphs, embeddings)])
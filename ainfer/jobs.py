@@ -0,0 +1,230 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from enum import Enum
+from functools import lru_cache
+from typing import Dict, Hashable, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from ainfer.ingest import IngestionProgress, ingest_files
+from ainfer.metrics import span
+from ainfer.types.files import File, ParsedFile
+from ainfer.types.ranking import EmbeddingMatrix
+
+LOGGER = logging.getLogger(__name__)
+INGESTION_WORKERS = int(os.environ.get('AINFER_INGESTION_WORKERS', 2))
+FINISHED_JOBS_MAX_COUNT = 1024  # finished jobs are kept for deduplication, the oldest ones are forgotten
+FAILED_JOB_RETRY_INTERVAL = 10 * 60  # seconds a failed file is not ingested again unless a retry is asked for
+
+
+class JobStatus(Enum):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def finished(self) -> bool:
+        return self in (JobStatus.DONE, JobStatus.FAILED, JobStatus.CANCELLED)
+
+
+class IngestionSummary(NamedTuple):
+    # what a finished job keeps of its progress, the parsed file and its embeddings are in the caches
+    ingested_pages: int
+    total_pages: int
+    paragraphs_count: int
+    embedding_failed: bool
+
+    @property
+    def fraction(self) -> float:
+        return self.ingested_pages / self.total_pages if self.total_pages else 1.0
+
+
+class IngestionJob:
+    """
+    Ingestion of one file with one embedding model. The job is run by a worker of the queue, any thread can poll its
+    status and progress, wait for it or cancel it. A cancelled job stops after the page range it is ingesting.
+    A job is shared by the sessions that submitted the file, its holders, and is cancelled once none of them holds it.
+    A finished job keeps a summary of its progress only, so that the jobs kept for deduplication hold no file data.
+    """
+
+    def __init__(self, file: File, backend, model: str):
+        self.id = f'{file.digest}:{model}'
+        self.digest = file.digest
+        self.name = file.name
+        self.model = model
+        self.status = JobStatus.QUEUED
+        self.progress: Optional[IngestionProgress] = None  # replaced by the summary once the job is finished
+        self.summary: Optional[IngestionSummary] = None
+        self.error: Optional[str] = None
+        self.finished_at: Optional[float] = None  # time.monotonic() of the end of the job
+        self._file: Optional[File] = file  # dropped once the job is finished
+        self._backend = backend
+        self._holders: Set[Hashable] = set()  # guarded by the lock of the queue
+        self._cancelled = threading.Event()
+        self._finished = threading.Event()
+
+    @property
+    def fraction(self) -> float:
+        if self.status is JobStatus.DONE:
+            return 1.0
+        progress = self.progress or self.summary
+        return progress.fraction if progress is not None else 0.0
+
+    @property
+    def ingested_pages(self) -> int:
+        progress = self.progress or self.summary
+        return progress.ingested_pages if progress is not None else 0
+
+    def snapshot(self) -> Tuple[List[ParsedFile], List[Optional[EmbeddingMatrix]]]:
+        # the part of the file that is searchable already, the embeddings are None while a part is not embedded.
+        # Empty once the job is finished, the whole file is in the caches then.
+        progress = self.progress
+        if progress is None:
+            return [], []
+        return progress.searchable.snapshot()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._finished.wait(timeout)
+
+    def run(self):
+        if self._cancelled.is_set():
+            self._finish(JobStatus.CANCELLED)
+            return
+        self.status = JobStatus.RUNNING
+        ingestion = ingest_files([self._file], self._backend, model=self.model)
+        try:
+            with span('ingest'):
+                for progress in ingestion:
+                    self.progress = progress
+                    if self._cancelled.is_set():
+                        LOGGER.info(f'Cancelled ingesting {self.name}.')
+                        self._finish(JobStatus.CANCELLED)
+                        return
+        except Exception as e:
+            LOGGER.exception(f'Failed ingesting {self.name}.')
+            self.error = str(e)
+            self._finish(JobStatus.FAILED)
+            return
+        finally:
+            ingestion.close()
+        # embedding failures are left to ranking, the file is parsed and cached all the same
+        self._finish(JobStatus.DONE)
+
+    def _finish(self, status: JobStatus):
+        progress = self.progress
+        if progress is not None:
+            self.summary = IngestionSummary(
+                progress.ingested_pages, progress.total_pages,
+                sum(len(parsed_file.paragraphs) for parsed_file in progress.parsed_files if parsed_file is not None),
+                progress.embedding_failed)
+        self.finished_at = time.monotonic()
+        self.status = status
+        self.progress = None
+        self._file = None
+        self._backend = None
+        self._finished.set()
+
+
+@lru_cache(maxsize=None)
+def get_job_queue() -> 'JobQueue':
+    # one queue per process, shared by all sessions, so jobs outlive the reruns and the sessions that submitted them
+    return JobQueue(INGESTION_WORKERS)
+
+
+class JobQueue:
+    """
+    Ingestion jobs run by worker threads in the order they are submitted. Jobs are deduplicated by the content hash of
+    the file and the model, so a file uploaded again or by another session is ingested once. Parsing itself is spread
+    over the parse process pool, the workers mostly wait on it and on the embedding API.
+    """
+
+    def __init__(self, workers: int):
+        self._jobs: Dict[str, IngestionJob] = {}
+        self._finished_ids: List[str] = []
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        for worker_index in range(workers):
+            threading.Thread(target=self._work, name=f'ingestion-worker-{worker_index}', daemon=True).start()
+
+    def submit(self, file: File, backend, model: str, holder: Optional[Hashable] = None,
+               retry: bool = False) -> IngestionJob:
+        """
+        Returns the job ingesting the file, queueing a new one unless there is one that is not cancelled. A failed job
+        is returned as well, so that a file that fails is not ingested again on every rerun, until
+        FAILED_JOB_RETRY_INTERVAL passes or `retry` is set. The holder, like a session id, is attached to the job
+        until it detaches.
+        """
+        job = IngestionJob(file, backend, model)
+        with self._lock:
+            existing_job = self._jobs.get(job.id)
+            if existing_job is not None and existing_job.status is not JobStatus.CANCELLED \
+                    and not existing_job.cancelled and not self._is_retried(existing_job, retry):
+                if holder is not None and not existing_job.status.finished():
+                    existing_job._holders.add(holder)  # nothing to cancel on a finished job, it is not held
+                return existing_job
+            if holder is not None:
+                job._holders.add(holder)
+            self._jobs[job.id] = job
+        LOGGER.info(f'Queued ingesting {file.name}.')
+        self._queue.put(job)
+        return job
+
+    def submit_files(self, files: Sequence[File], backend, model: str,
+                     holder: Optional[Hashable] = None, retry: bool = False) -> List[IngestionJob]:
+        return [self.submit(file, backend, model, holder, retry) for file in files]
+
+    def get(self, job_id: str) -> Optional[IngestionJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str):
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel()
+
+    def detach(self, job: IngestionJob, holder: Hashable):
+        # the job goes on for the other holders, jobs submitted without a holder are never cancelled this way
+        with self._lock:
+            job._holders.discard(holder)
+            if not job._holders and not job.status.finished():
+                LOGGER.info(f'Cancelling ingesting {job.name}, no session waits for it.')
+                job.cancel()
+
+    @staticmethod
+    def _is_retried(job: IngestionJob, retry: bool) -> bool:
+        if job.status is not JobStatus.FAILED:
+            return False
+        return retry or time.monotonic() - job.finished_at >= FAILED_JOB_RETRY_INTERVAL
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                job.run()
+            finally:
+                self._forget_finished(job)
+
+    def _forget_finished(self, job: IngestionJob):
+        with self._lock:
+            job._holders.clear()
+            self._finished_ids.append(job.id)
+            while len(self._finished_ids) > FINISHED_JOBS_MAX_COUNT:
+                finished_id = self._finished_ids.pop(0)
+                finished_job = self._jobs.get(finished_id)
+                if finished_job is not None and finished_job.status.finished():
+                    del self._jobs[finished_id]
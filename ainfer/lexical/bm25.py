@@ -0,0 +1,97 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+"""
+
+import re
+import math
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+TERM_PATTERN = re.compile(r'\w+')
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize_terms(text: str) -> List[str]:
+    # identifiers like gene ids or equation names are matched as they are written, ignoring the case only
+    return TERM_PATTERN.findall(text.lower())
+
+
+@dataclass(frozen=True, eq=False)
+class BM25Index:
+    """Inverted index over the paragraphs of a file. Postings of all terms are stored contiguously, term by term."""
+    terms: Dict[str, int]  # term -> term id
+    offsets: np.ndarray  # int64, postings of a term id t are offsets[t]:offsets[t + 1]
+    paragraphs: np.ndarray  # int32, paragraph index of every posting
+    frequencies: np.ndarray  # float32, term frequency of every posting
+    lengths: np.ndarray  # int32, number of terms of every paragraph
+
+    @staticmethod
+    def build(paragraphs: Iterable[str]) -> 'BM25Index':
+        terms, lengths = {}, []
+        postings_terms, postings_paragraphs, postings_frequencies = [], [], []
+        for paragraph_index, paragraph in enumerate(paragraphs):
+            counts = Counter(tokenize_terms(paragraph))
+            lengths.append(sum(counts.values()))
+            for term, count in counts.items():
+                postings_terms.append(terms.setdefault(term, len(terms)))
+                postings_paragraphs.append(paragraph_index)
+                postings_frequencies.append(count)
+
+        postings_terms = np.asarray(postings_terms, dtype=np.int64)
+        order = np.argsort(postings_terms, kind='stable')
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(postings_terms, minlength=len(terms)), out=offsets[1:])
+        return BM25Index(
+            terms=terms,
+            offsets=offsets,
+            paragraphs=np.asarray(postings_paragraphs, dtype=np.int32)[order],
+            frequencies=np.asarray(postings_frequencies, dtype=np.float32)[order],
+            lengths=np.asarray(lengths, dtype=np.int32))
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    @property
+    def nbytes(self) -> int:
+        # the vocabulary is estimated by the length of its terms, the dict overhead is left out
+        return (sum(map(len, self.terms)) + self.offsets.nbytes + self.paragraphs.nbytes + self.frequencies.nbytes
+                + self.lengths.nbytes)
+
+    def postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        # paragraph indices containing the term and the term frequencies in them
+        term_id = self.terms.get(term)
+        if term_id is None:
+            return self.paragraphs[:0], self.frequencies[:0]
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return self.paragraphs[start:end], self.frequencies[start:end]
+
+
+def bm25_scores(indexes: Sequence[BM25Index], query: str, k1: float = BM25_K1, b: float = BM25_B) -> np.ndarray:
+    """
+    BM25 scores of the paragraphs of all files, concatenated in the order of the files.
+    Document frequencies and the average paragraph length are taken over all the files, as if they were one corpus.
+    """
+    files_offsets = np.cumsum([0] + [len(index) for index in indexes])
+    scores = np.zeros(files_offsets[-1], dtype=np.float32)
+    if not len(scores):
+        return scores
+
+    average_length = max(sum(int(index.lengths.sum()) for index in indexes) / len(scores), 1.0)
+    for term in set(tokenize_terms(query)):
+        files_postings = [index.postings(term) for index in indexes]
+        document_frequency = sum(len(paragraphs) for paragraphs, _ in files_postings)
+        if not document_frequency:
+            continue
+        idf = math.log(1 + (len(scores) - document_frequency + 0.5) / (document_frequency + 0.5))
+        for file_offset, index, (paragraphs, frequencies) in zip(files_offsets, indexes, files_postings):
+            if not len(paragraphs):
+                continue
+            length_norms = k1 * (1 - b + b * index.lengths[paragraphs] / average_length)
+            scores[file_offset + paragraphs] += idf * frequencies * (k1 + 1) / (frequencies + length_norms)
+    return scores
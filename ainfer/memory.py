@@ -4,49 +4,210 @@
  Date: Feb 03 2023
 """
 
+import os
 import logging
-from typing import List, Iterable
+import tempfile
+import threading
+import weakref
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Iterable, Optional
 
 from ainfer.types.files import File
 
 import streamlit as st
 
 LOGGER = logging.getLogger(__name__)
-MEMORIZED_FILE_SUFFIX = '_memorized_file'
+DEFAULT_MEMORY_FOLDER = '/tmp/ainfer/memory'
+MEMORY_MAX_BYTES = int(os.environ.get('AINFER_MEMORY_MAX_BYTES', 1024 * 1024 * 1024))
+MEMORY_DISK_MAX_BYTES = int(os.environ.get('AINFER_MEMORY_DISK_MAX_BYTES', 8 * 1024 * 1024 * 1024))
+MEMORIZED_FILES_KEY = '_memorized_files'
+
+
+@lru_cache(maxsize=None)
+def get_blob_store() -> 'BlobStore':
+    # one store per process, shared by all sessions
+    return BlobStore(Path(DEFAULT_MEMORY_FOLDER), MEMORY_MAX_BYTES, MEMORY_DISK_MAX_BYTES)
+
+
+class BlobStore:
+    """
+    Contents of files stored once by their content hash and counted references to them.
+    Blobs are kept in memory within `max_bytes`, the least recently used ones are spilled to disk and read back
+    on use. A blob is deleted as soon as nothing references it. Spilled blobs above `disk_max_bytes` are deleted
+    too, the least recently used first, unless they are referenced in this process. The folder may be shared with
+    other processes, which may delete the blobs referenced here, so the holders of a reference restore the content
+    when they find it missing.
+    """
+
+    def __init__(self, folder: Path, max_bytes: int, disk_max_bytes: int):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self._blobs: Dict[str, bytes] = OrderedDict()  # digest -> content, the least recently used first
+        self._blobs_bytes = 0
+        self._references = Counter()
+        self._lock = threading.Lock()
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def nbytes(self) -> int:
+        return self._blobs_bytes
+
+    def __contains__(self, digest: str) -> bool:
+        with self._lock:
+            return digest in self._blobs or self._path(digest).exists()
+
+    def put(self, digest: str, value: bytes):
+        """Adds a reference to the content, storing it if it is not stored yet."""
+        with self._lock:
+            self._references[digest] += 1
+            if digest in self._blobs:
+                self._blobs.move_to_end(digest)
+            else:
+                self._keep_in_memory(digest, value)
+
+    def get(self, digest: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._blobs.get(digest)
+            if value is not None:
+                self._blobs.move_to_end(digest)
+                return value
+            try:
+                value = self._path(digest).read_bytes()
+            except FileNotFoundError:
+                return None
+            self._keep_in_memory(digest, value)
+            return value
+
+    def restore(self, digest: str, value: bytes):
+        """Stores the content of a referenced blob again, if it is not stored anymore."""
+        with self._lock:
+            if digest in self._blobs or self._path(digest).exists():
+                return
+            LOGGER.info(f'Restored blob {digest}.')
+            self._keep_in_memory(digest, value)
+
+    def release(self, digest: str):
+        """Removes a reference to the content, deleting the content once there are none left."""
+        with self._lock:
+            self._references[digest] -= 1
+            if self._references[digest] > 0:
+                return
+            del self._references[digest]
+            value = self._blobs.pop(digest, None)
+            if value is not None:
+                self._blobs_bytes -= len(value)
+            self._path(digest).unlink(missing_ok=True)
+
+    def _keep_in_memory(self, digest: str, value: bytes):
+        self._blobs[digest] = value
+        self._blobs_bytes += len(value)
+        spilled = False
+        while self._blobs_bytes > self.max_bytes and self._blobs:
+            spilled_digest, spilled_value = self._blobs.popitem(last=False)
+            self._blobs_bytes -= len(spilled_value)
+            self._spill(spilled_digest, spilled_value)
+            spilled = True
+        if spilled:
+            self._evict_spilled()
+
+    def _spill(self, digest: str, value: bytes):
+        path = self._path(digest)
+        if path.exists():
+            os.utime(path)
+            return
+        fd, temporary_path = tempfile.mkstemp(dir=self.folder)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(value)
+        os.replace(temporary_path, path)
+
+    def _evict_spilled(self):
+        # the least recently spilled blobs go first, the referenced ones are kept even above the limit
+        paths = sorted(self.folder.glob('*.blob'), key=lambda path: path.stat().st_mtime, reverse=True)
+        total_bytes = 0
+        for path in paths:
+            total_bytes += path.stat().st_size
+            if total_bytes > self.disk_max_bytes and path.stem not in self._references:
+                LOGGER.info(f'Evicted blob {path.stem} from disk.')
+                total_bytes -= path.stat().st_size
+                path.unlink(missing_ok=True)
+        if total_bytes > self.disk_max_bytes:
+            LOGGER.warning(f'Referenced blobs take {total_bytes} bytes on disk, above the limit of '
+                           f'{self.disk_max_bytes}.')
+
+    def _path(self, digest: str) -> Path:
+        return self.folder / f'{digest}.blob'
+
+
+class SessionFiles:
+    """
+    Files of a session indexed by name. The session holds handles only, every content is referenced
+    in the blob store, and the references are released when the session is gone.
+    """
+
+    def __init__(self, store: BlobStore):
+        self._store = store
+        self._digests: Dict[str, str] = {}  # name -> digest
+        weakref.finalize(self, _release_digests, store, self._digests)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._digests
+
+    def __len__(self) -> int:
+        return len(self._digests)
+
+    def add(self, file: File):
+        previous_digest = self._digests.get(file.name)
+        if previous_digest == file.digest:
+            self._store.restore(file.digest, file.value)  # in case another process deleted it
+            return
+        self._store.put(file.digest, file.value)
+        self._digests[file.name] = file.digest
+        if previous_digest is not None:
+            self._store.release(previous_digest)
+
+    def get(self, name: str) -> File:
+        digest = self._digests[name]
+        value = self._store.get(digest)
+        if value is None:
+            raise KeyError(name)
+        return File.with_digest(name, value, digest)
+
+    def files(self) -> List[File]:
+        # files evicted from the store are left out
+        files = []
+        for name in list(self._digests):
+            try:
+                files.append(self.get(name))
+            except KeyError:
+                LOGGER.warning(f'File {name} is not in memory anymore.')
+        return files
+
+
+def get_session_files(key: str) -> SessionFiles:
+    if key not in st.session_state:
+        st.session_state[key] = SessionFiles(get_blob_store())
+    return st.session_state[key]
 
 
 def memorize_files(files: Iterable[File]):
+    memorized_files = get_session_files(MEMORIZED_FILES_KEY)
     for file in files:
-        memorized_file_key = _memorized_file_key_from_file(file)
-        if memorized_file_key in st.session_state:
-            del st.session_state[memorized_file_key]
-        st.session_state[memorized_file_key] = file.value
-        LOGGER.info(f'Memorized file {file.name}.')
+        if file.name not in memorized_files:
+            LOGGER.info(f'Memorized file {file.name}.')
+        memorized_files.add(file)
 
 
 def get_files_from_memory() -> List[File]:
-    files = list(map(_file_from_memorized_file, filter(_is_memorized_file, st.session_state.items())))
+    files = get_session_files(MEMORIZED_FILES_KEY).files()
 
     LOGGER.info(f'Got {len(files)} files from memory.')
 
     return files
 
 
-def _memorized_file_key_from_file(file: File) -> str:
-    return file.name + MEMORIZED_FILE_SUFFIX
-
-
-def _is_memorized_file(memorized_file) -> bool:
-    memorized_file_key, _ = memorized_file
-    return memorized_file_key.endswith(MEMORIZED_FILE_SUFFIX)
-
-
-def _file_name_from_memorized_file_key(memorized_file_key: str) -> str:
-    return memorized_file_key[:-len(MEMORIZED_FILE_SUFFIX)]
-
-
-def _file_from_memorized_file(memorized_file) -> File:
-    memorized_file_key, memorized_file_value = memorized_file
-    return File(
-        name=_file_name_from_memorized_file_key(memorized_file_key),
-        value=memorized_file_value)
+def _release_digests(store: BlobStore, digests: Dict[str, str]):
+    for digest in digests.values():
+        store.release(digest)
@@ -0,0 +1,168 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+"""
+
+import os
+import json
+import time
+import bisect
+import cProfile
+import logging
+import threading
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+LOGGER = logging.getLogger(__name__)
+METRICS_FORMAT = os.environ.get('AINFER_METRICS')  # prometheus or jsonl, metrics are disabled when unset
+METRICS_PATH = os.environ.get('AINFER_METRICS_PATH', '/tmp/ainfer/metrics')
+PROFILE_FOLDER = os.environ.get('AINFER_PROFILE_FOLDER')  # every request is profiled into it when set
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # seconds
+
+STAGE_SECONDS = 'ainfer_stage_seconds'
+REMOTE_CALL_SECONDS = 'ainfer_remote_call_seconds'
+CACHE_REQUESTS = 'ainfer_cache_requests_total'
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# Counters and histograms of the process, keyed by name and labels. A histogram is a list of the counts of
+# observations per bucket, the last one for observations above all buckets, followed by their count and sum.
+_COUNTERS: Dict[Tuple[str, Labels], float] = {}
+_HISTOGRAMS: Dict[Tuple[str, Labels], List[float]] = {}
+_LOCK = threading.Lock()
+_NULL_SPAN = nullcontext()
+
+
+def increment(name: str, value: float = 1, **labels: str):
+    if METRICS_FORMAT is None:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _LOCK:
+        _COUNTERS[key] = _COUNTERS.get(key, 0) + value
+
+
+def observe(name: str, seconds: float, **labels: str):
+    if METRICS_FORMAT is None:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _LOCK:
+        histogram = _HISTOGRAMS.get(key)
+        if histogram is None:
+            histogram = _HISTOGRAMS[key] = [0] * (len(LATENCY_BUCKETS) + 3)
+        histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        histogram[-2] += 1
+        histogram[-1] += seconds
+
+
+def count_cache_requests(cache: str, hit: bool, count: int = 1):
+    increment(CACHE_REQUESTS, count, cache=cache, result='hit' if hit else 'miss')
+
+
+def span(stage: str):
+    """Times the stage of a request into a histogram: `with span('rank'): ...`. Costs nothing when disabled."""
+    if METRICS_FORMAT is None:
+        return _NULL_SPAN
+    return _timed_span(STAGE_SECONDS, stage=stage)
+
+
+def timed_remote_call(call: str) -> Callable:
+    """Decorator timing every call of a function that calls a remote API. Disabled, it returns the function as is."""
+    def decorator(function: Callable) -> Callable:
+        if METRICS_FORMAT is None:
+            return function
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with _timed_span(REMOTE_CALL_SECONDS, call=call):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def _timed_span(name: str, **labels: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+@contextmanager
+def profile(request: str):
+    """Dumps cProfile stats of the block into PROFILE_FOLDER, to be read with `pstats` or snakeviz."""
+    if PROFILE_FOLDER is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        folder = Path(PROFILE_FOLDER)
+        folder.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(folder / f'{request}-{time.time_ns()}.pstats')
+
+
+def export_prometheus() -> str:
+    lines = []
+    with _LOCK:
+        counters, histograms = dict(_COUNTERS), {key: list(value) for key, value in _HISTOGRAMS.items()}
+
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f'# TYPE {name} counter')
+        lines.extend(f'{name}{_format_labels(labels)} {value:g}'
+                     for (counter_name, labels), value in sorted(counters.items()) if counter_name == name)
+
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f'# TYPE {name} histogram')
+        for (histogram_name, labels), histogram in sorted(histograms.items()):
+            if histogram_name != name:
+                continue
+            cumulative_count = 0
+            for bucket, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram):
+                cumulative_count += count
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", str(bucket)),))} {cumulative_count:g}')
+            lines.append(f'{name}_count{_format_labels(labels)} {histogram[-2]:g}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {histogram[-1]:g}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def export_json_lines() -> str:
+    timestamp = time.time()
+    with _LOCK:
+        records = [{'timestamp': timestamp, 'type': 'counter', 'name': name, 'labels': dict(labels), 'value': value}
+                   for (name, labels), value in _COUNTERS.items()]
+        records.extend({'timestamp': timestamp, 'type': 'histogram', 'name': name, 'labels': dict(labels),
+                        'buckets': dict(zip(map(str, LATENCY_BUCKETS + ('+Inf',)), histogram[:-2])),
+                        'count': histogram[-2], 'sum': histogram[-1]}
+                       for (name, labels), histogram in _HISTOGRAMS.items())
+    return ''.join(json.dumps(record) + '\n' for record in records)
+
+
+def write_metrics(path: Optional[str] = None):
+    # Prometheus text is rewritten for a scraper or a node exporter to pick up, JSON lines are appended
+    if METRICS_FORMAT is None:
+        return
+    path = Path(path or METRICS_PATH)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if METRICS_FORMAT == 'prometheus':
+        temporary_path = path.with_name(path.name + '.tmp')
+        temporary_path.write_text(export_prometheus())
+        temporary_path.replace(path)
+    elif METRICS_FORMAT == 'jsonl':
+        with path.open('a') as f:
+            f.write(export_json_lines())
+    else:
+        LOGGER.warning(f'Unknown metrics format: {METRICS_FORMAT}.')
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
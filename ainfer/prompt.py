@@ -0,0 +1,66 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+"""
+
+import re
+import math
+from typing import Sequence
+
+PROMPT_MAX_TOKENS = 1900
+BYTES_PER_TOKEN = 4  # a token of the Cohere tokenizer covers about 4 bytes of a word, shorter words are a token each
+TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]')
+
+ANSWER_PROMPT_TEMPLATE = (
+    'Read the paragraphs from the context below and answer the question, if the question cannot be answered based on the context alone, write "sorry i had trouble answering this question, based on the provided information \n'
+    "\n"
+    "Context:\n"
+    "{context}\n"
+    "\n"
+    "Question: {question}\n"
+    "Answer:")
+
+SUMMARY_PROMPT_TEMPLATE = (
+    'Read the paragraph below and summarize it in a few sentences, if the context can not be summarized, write "Sorry, I could not come up with a good summary \n'
+    "\n"
+    "Paragraph:\n"
+    "{context}\n"
+    "\n"
+    "Summary:")
+
+
+def estimate_tokens_count(text: str) -> int:
+    # Calibrated local estimate instead of a remote tokenize call, it errs on the side of more tokens:
+    # every word or punctuation mark is at least one token and long or non-ASCII words are split further
+    return sum(math.ceil(len(match.encode()) / BYTES_PER_TOKEN) for match in TOKEN_PATTERN.findall(text))
+
+
+def build_answer_prompt(question: str, paragraphs: Sequence[str], max_tokens: int = PROMPT_MAX_TOKENS) -> str:
+    """
+    Paragraphs are expected in the context order, the most relevant last, the way `choose_paragraphs_for_context`
+    returns them. The most relevant whole paragraphs that fit the budget are kept in that order,
+    the instruction and the question are never cut.
+    """
+    budget = max_tokens - estimate_tokens_count(ANSWER_PROMPT_TEMPLATE.format(context='', question=question))
+    kept = [False] * len(paragraphs)
+    for i in reversed(range(len(paragraphs))):
+        paragraph_tokens_count = estimate_tokens_count(paragraphs[i]) + 1  # the newline that joins paragraphs
+        if paragraph_tokens_count <= budget:
+            kept[i] = True
+            budget -= paragraph_tokens_count
+
+    context = '\n'.join(paragraph for paragraph, is_kept in zip(paragraphs, kept) if is_kept)
+    return ANSWER_PROMPT_TEMPLATE.format(context=context, question=question)
+
+
+def build_summary_prompt(text: str, max_tokens: int = PROMPT_MAX_TOKENS) -> str:
+    # the instruction is kept and the text is cut from the end, at a word boundary
+    budget = max_tokens - estimate_tokens_count(SUMMARY_PROMPT_TEMPLATE.format(context=''))
+    tokens_count = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        tokens_count += math.ceil(len(match.group().encode()) / BYTES_PER_TOKEN)
+        if tokens_count > budget:
+            text = text[:match.start()]
+            break
+    return SUMMARY_PROMPT_TEMPLATE.format(context=text)
@@ -4,109 +4,346 @@
  Date: Feb 03 2023
 """
 
+import math
 import logging
-from itertools import islice, chain
-from collections import deque
-from operator import itemgetter
-from statistics import stdev
-from typing import Sequence, Deque, List, Optional
+import threading
+from itertools import chain
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from typing import Dict, Hashable, Sequence, List, Optional, Tuple, Mapping
 import streamlit as st
 
 import numpy as np
 
 from ainfer.cache import (
-    parsed_file_embeddings_are_cached,
     get_parsed_file_embeddings_from_cache,
-    cache_parsed_file_embeddings)
+    cache_parsed_file_embeddings,
+    get_ivf_file_lists_from_cache,
+    cache_ivf_file_lists,
+    get_lexical_index_from_cache)
+from ainfer.backends.local import embed_locally
+from ainfer.embeddings.batching import embed_texts, EmbeddingError
+from ainfer.embeddings.index import IVFIndex, build_ivf_index, index_file_embeddings, search_embeddings, top_k_indices
+from ainfer.embeddings.store import get_embedding_store
+from ainfer.lexical.bm25 import BM25Index, bm25_scores
+from ainfer.metrics import span, count_cache_requests
+from ainfer.prompt import estimate_tokens_count
 from ainfer.types.files import ParsedFile
-from ainfer.types.ranking import RankedParagraph
+from ainfer.types.ranking import RankedParagraph, ParagraphId, EmbeddingMatrix
 
 LOGGER = logging.getLogger(__name__)
 PARAGRAPHS_IN_CONTEXT_MAX_COUNT = 10
+RANKED_PARAGRAPHS_COUNT = 2 * PARAGRAPHS_IN_CONTEXT_MAX_COUNT  # candidates the context is chosen from
 STD_THRESHOLD = 0.01
+CONTEXT_POLICY = 'stdev'  # stdev, mmr or tokens
+MMR_RELEVANCE_WEIGHT = 0.7  # the rest of the MMR score penalizes similarity to the paragraphs chosen already
+CONTEXT_MAX_TOKENS = 1500  # budget of the tokens policy, the prompt cuts the context to its own budget regardless
+RETRIEVAL_MODE = 'hybrid'  # dense, lexical or hybrid
+HYBRID_LEXICAL_WEIGHT = 0.3  # share of the normalized BM25 score in the hybrid score, the rest is cosine similarity
+HYBRID_CANDIDATES_FACTOR = 4  # candidates taken from each retriever per paragraph returned
+QUESTION_EMBEDDING_WAIT = 2.0  # seconds a question waits for its embedding before it is ranked lexically
+BACKGROUND_EMBEDDING_WORKERS = 2
 
+# missing embeddings are requested in the background, questions do not wait for the retries of an API that is down
+_EMBEDDING_EXECUTOR = ThreadPoolExecutor(max_workers=BACKGROUND_EMBEDDING_WORKERS, thread_name_prefix='embedding')
+_EMBEDDINGS_IN_FLIGHT: Dict[Hashable, Future] = {}
+_EMBEDDINGS_IN_FLIGHT_LOCK = threading.Lock()
 
-def rank_paragraphs(parsed_files, question, co, model) -> Sequence[RankedParagraph]:
-    files_and_paragraphs = tuple((file, paragraph) for file in parsed_files for paragraph in file.paragraphs)
 
-    embeddings = get_embeddings(parsed_files, question, co, model)
+def rank_paragraphs(parsed_files, question, backend, model, top_k=RANKED_PARAGRAPHS_COUNT,
+                    mode=RETRIEVAL_MODE) -> Optional[Sequence[RankedParagraph]]:
+    if mode == 'lexical':
+        return rank_lexical_paragraphs(parsed_files, question, top_k)
 
-    paragraph_embeddings, search_embedding = islice(embeddings, 0, len(embeddings) - 1), embeddings[-1]
+    embeddings = get_ready_embeddings(parsed_files, question, backend, model)
+    if embeddings is None:
+        LOGGER.info('Embeddings are not ready, ranking the paragraphs lexically.')
+        return rank_lexical_paragraphs(parsed_files, question, top_k)
 
-    similarities = (get_similarity(paragraph_embedding, search_embedding)
-                    for paragraph_embedding in paragraph_embeddings)
+    files_embeddings, question_embedding = embeddings
 
-    files_paragraphs_similarities = ((*file_and_paragraph, similarity)
-                                     for (file_and_paragraph, similarity) in
-                                     zip(files_and_paragraphs, similarities))
+    index = _get_ivf_index(parsed_files, files_embeddings, model)
+    return rank_embedded_paragraphs(parsed_files, files_embeddings, question_embedding, top_k, index,
+                                    question=question if mode == 'hybrid' else None)
 
-    return list(sorted(files_paragraphs_similarities, key=itemgetter(-1)))
 
+def rank_embedded_paragraphs(parsed_files, files_embeddings, question_embedding, top_k=RANKED_PARAGRAPHS_COUNT,
+                             index=None, question=None) -> Sequence[RankedParagraph]:
+    # Only the top_k most similar paragraphs are returned, sorted by similarity in ascending order.
+    # Given the question, cosine similarities are fused with its BM25 scores.
+    with span('rank'):
+        if question is None:
+            rows, similarities = search_embeddings(files_embeddings, question_embedding, top_k, index)
+        else:
+            rows, similarities = _search_hybrid(
+                parsed_files, files_embeddings, question_embedding, question, top_k, index)
+        return _build_ranked_paragraphs(parsed_files, rows, similarities)
 
-def choose_paragraphs_for_context(ranked_paragraphs: List[RankedParagraph]) -> Sequence[RankedParagraph]:
-    paragraphs_for_context = deque((ranked_paragraphs.pop(),))
 
-    for candidate in reversed(ranked_paragraphs):
+def rank_lexical_paragraphs(parsed_files, question, top_k=RANKED_PARAGRAPHS_COUNT) -> Sequence[RankedParagraph]:
+    # Needs no embeddings and no network, paragraphs without any term of the question are left out
+    with span('rank'):
+        scores = _get_normalized_lexical_scores(parsed_files, question)
+        rows = top_k_indices(scores, top_k)
+        rows = rows[scores[rows] > 0]
+        return _build_ranked_paragraphs(parsed_files, rows, scores[rows])
 
-        _, _, similarity = candidate
 
-        current_similarities = map(itemgetter(-1), paragraphs_for_context)
+def _build_ranked_paragraphs(parsed_files, rows, similarities) -> Sequence[RankedParagraph]:
+    files_offsets = np.cumsum([0] + [len(parsed_file.paragraphs) for parsed_file in parsed_files])
+    files_indices = np.searchsorted(files_offsets, rows, side='right') - 1
 
-        if stdev(chain((similarity,), current_similarities)) >= STD_THRESHOLD:
-            break
-        if len(paragraphs_for_context) >= PARAGRAPHS_IN_CONTEXT_MAX_COUNT:
+    paragraphs_ids = [ParagraphId(int(file_index), int(row - files_offsets[file_index]))
+                      for row, file_index in zip(rows, files_indices)]
+
+    return [RankedParagraph(
+                file=parsed_files[paragraph_id.file_index],
+                paragraph=parsed_files[paragraph_id.file_index].paragraphs[paragraph_id.paragraph_index],
+                paragraph_id=paragraph_id,
+                similarity=float(similarity))
+            for paragraph_id, similarity in zip(paragraphs_ids, similarities)]
+
+
+def choose_paragraphs_for_context(ranked_paragraphs: Sequence[RankedParagraph], policy: str = CONTEXT_POLICY,
+                                  max_count: int = PARAGRAPHS_IN_CONTEXT_MAX_COUNT,
+                                  model: Optional[str] = None) -> Sequence[RankedParagraph]:
+    """
+    Chooses at most max_count paragraphs for the context among the ranked paragraphs, which come sorted by similarity
+    in ascending order. stdev takes the best paragraphs while their similarities stay within STD_THRESHOLD of each
+    other, mmr takes relevant paragraphs that do not repeat each other by their embeddings of the model and tokens
+    takes the best ones that fit CONTEXT_MAX_TOKENS. The chosen paragraphs are returned in the same order,
+    the most similar last.
+    """
+    if not ranked_paragraphs:
+        return []
+    similarities = np.fromiter((paragraph.similarity for paragraph in reversed(ranked_paragraphs)),
+                               dtype=np.float64, count=len(ranked_paragraphs))  # the best first
+
+    if policy == 'stdev':
+        rows = np.arange(_count_similar(similarities, STD_THRESHOLD, max_count))
+    elif policy == 'mmr':
+        vectors = _get_paragraphs_vectors([paragraph.paragraph for paragraph in reversed(ranked_paragraphs)], model)
+        rows = _select_diverse(similarities, vectors, MMR_RELEVANCE_WEIGHT, max_count)
+    elif policy == 'tokens':
+        tokens_counts = [estimate_tokens_count(paragraph.paragraph) + 1 for paragraph in reversed(ranked_paragraphs)]
+        fitting_count = np.searchsorted(np.cumsum(tokens_counts), CONTEXT_MAX_TOKENS, side='right')
+        rows = np.arange(max(1, min(fitting_count, max_count)))
+    else:
+        raise ValueError(f'Unknown context policy: {policy}.')
+
+    return [ranked_paragraphs[len(ranked_paragraphs) - 1 - row] for row in np.sort(rows)[::-1]]
+
+
+def _count_similar(similarities: np.ndarray, std_threshold: float, max_count: int) -> int:
+    # Number of the best similarities whose sample standard deviation stays below the threshold.
+    # Mean and variance are updated in O(1) per similarity with Welford's algorithm, stable even for close values.
+    count, mean, squared_deviations = 1, float(similarities[0]), 0.0
+    for similarity in similarities[1:max_count].tolist():
+        delta = similarity - mean
+        candidate_mean = mean + delta / (count + 1)
+        candidate_squared_deviations = squared_deviations + delta * (similarity - candidate_mean)
+        if math.sqrt(candidate_squared_deviations / count) >= std_threshold:
             break
-        paragraphs_for_context.appendleft(candidate)
+        count, mean, squared_deviations = count + 1, candidate_mean, candidate_squared_deviations
+    return count
 
-    return paragraphs_for_context
 
+def _get_paragraphs_vectors(paragraphs: Sequence[str], model: Optional[str]) -> np.ndarray:
+    # Unit embeddings the paragraphs were ranked with, taken from the store, so that MMR measures the same similarity
+    # as the ranking. Paragraphs ranked lexically may have none, all of them get local embeddings then.
+    embeddings = get_embedding_store(model).get(paragraphs) if model is not None else [None]
+    if any(embedding is None for embedding in embeddings):
+        return embed_locally(paragraphs)
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), np.finfo(np.float32).tiny)
 
-def get_similarity(a, b):
-    # TODO: Try BERT for similarity
-    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
 
+def _select_diverse(similarities: np.ndarray, vectors: np.ndarray, relevance_weight: float,
+                    max_count: int) -> np.ndarray:
+    # maximal marginal relevance, the vectors are unit ones, so their dot products are cosine similarities
+    selected = np.zeros(len(similarities), dtype=bool)
+    max_redundancies = np.full(len(similarities), -np.inf)
+    row = 0  # the most similar paragraph goes first
+    for _ in range(min(max_count, len(similarities))):
+        selected[row] = True
+        np.maximum(max_redundancies, vectors @ vectors[row], out=max_redundancies)
+        scores = relevance_weight * similarities - (1 - relevance_weight) * max_redundancies
+        scores[selected] = -np.inf
+        row = int(np.argmax(scores))
+    return np.flatnonzero(selected)
+
+
+def _search_hybrid(parsed_files, files_embeddings, question_embedding, question, top_k,
+                   index=None) -> Tuple[np.ndarray, np.ndarray]:
+    # both retrievers propose candidates, all of them get both scores and the best fused ones are kept
+    lexical_scores = _get_normalized_lexical_scores(parsed_files, question)
+    candidates_count = top_k * HYBRID_CANDIDATES_FACTOR
+    dense_rows, _ = search_embeddings(files_embeddings, question_embedding, candidates_count, index)
+    lexical_rows = top_k_indices(lexical_scores, candidates_count)
+    rows = np.union1d(dense_rows, lexical_rows[lexical_scores[lexical_rows] > 0])
+
+    files_offsets = np.cumsum([0] + [len(file_embeddings) for file_embeddings in files_embeddings])
+    files_indices = np.searchsorted(files_offsets, rows, side='right') - 1
+    dense_scores = np.empty(len(rows), dtype=np.float32)
+    for file_index in np.unique(files_indices):
+        in_file = files_indices == file_index
+        dense_scores[in_file] = files_embeddings[file_index].similarities(
+            question_embedding, rows[in_file] - files_offsets[file_index])
+
+    scores = (1 - HYBRID_LEXICAL_WEIGHT) * dense_scores + HYBRID_LEXICAL_WEIGHT * lexical_scores[rows]
+    best = top_k_indices(scores, top_k)
+    return rows[best], scores[best]
+
+
+def _get_normalized_lexical_scores(parsed_files, question) -> np.ndarray:
+    # scaled to [0, 1] by the best score, so that they are comparable with cosine similarities
+    scores = bm25_scores([_get_lexical_index(parsed_file) for parsed_file in parsed_files], question)
+    if len(scores) and scores.max() > 0:
+        scores /= scores.max()
+    return scores
+
+
+def _get_lexical_index(parsed_file: ParsedFile) -> BM25Index:
+    # files with the pages parsed so far share the digest of the whole file, their index is built on the fly
+    lexical_index = get_lexical_index_from_cache(parsed_file)
+    if lexical_index is not None and len(lexical_index) == len(parsed_file.paragraphs):
+        return lexical_index
+    return BM25Index.build(parsed_file.paragraphs)
+
+
+def _get_ivf_index(parsed_files, files_embeddings, model) -> Optional[IVFIndex]:
+    # the lists of every file are built once, an index over another set of the files reuses them
+    files_lists = [get_ivf_file_lists_from_cache(parsed_file, model) for parsed_file in parsed_files]
+    index = build_ivf_index([parsed_file.digest for parsed_file in parsed_files], files_embeddings, model, files_lists)
+    if index is not None:
+        for parsed_file, cached_file_lists, file_lists in zip(parsed_files, files_lists, index.files_lists):
+            if cached_file_lists is None:
+                cache_ivf_file_lists(parsed_file, model, file_lists)
+        LOGGER.info('Searching an index over %d paragraphs.', len(index))
+    return index
 
-def get_embeddings(parsed_files, question, co, model):
-    embeddings, parsed_files_without_embeddings = [], []
-    for parsed_file in parsed_files:
-        if parsed_file_embeddings_are_cached(parsed_file):
-            embeddings.extend(get_parsed_file_embeddings_from_cache(parsed_file))
-            LOGGER.info('Obtained embeddings from cache for %s.', parsed_file.name)
-        else:
-            # We want to preserve the order of embeddings, that's why we put None in place of missing embeddings
-            embeddings.extend([None] * len(parsed_file.paragraphs))
-            parsed_files_without_embeddings.append(parsed_file)
 
-    paragraphs_without_embeddings = (paragraph for parsed_file in parsed_files_without_embeddings
-                                     for paragraph in parsed_file.paragraphs)
-    texts = tuple(chain(paragraphs_without_embeddings, (question,)))
+def get_ready_embeddings(parsed_files, question, backend, model) -> Optional[Tuple[List[EmbeddingMatrix], np.ndarray]]:
+    """
+    Embeddings of the files and the question, without waiting for the paragraphs to be embedded. Missing embeddings
+    are requested in the background, so that later questions find them. With all the paragraphs embedded, the question
+    waits QUESTION_EMBEDDING_WAIT at most for its own embedding. None if the embeddings are not ready by then.
+    """
+    embedding_store = get_embedding_store(model)
+    files_are_embedded = all(
+        get_parsed_file_embeddings_from_cache(parsed_file, model) is not None
+        or all(embedding is not None for embedding in embedding_store.get(parsed_file.paragraphs))
+        for parsed_file in parsed_files)
+    if files_are_embedded and embedding_store.get((question,))[0] is not None:
+        return get_embeddings(parsed_files, question, backend, model)  # no requests to send
 
+    future = _embed_in_background(parsed_files, question, backend, model)
     try:
-        new_embeddings = co.embed(texts=texts, model=model).embeddings
-    except Exception as e:
-        warning_message = 'Sorry, we are experiencing high traffic. \n Please, try again in a minute or try a smaller file'
-        st.sidebar.warning(warning_message, icon="⚠️")
+        return future.result(timeout=QUESTION_EMBEDDING_WAIT if files_are_embedded else 0)
+    except TimeoutError:
         return None
+    except EmbeddingError:
+        _warn_embedding_failed()
+        return None
+
+
+def get_embeddings(parsed_files, question, backend, model) -> Optional[Tuple[List[EmbeddingMatrix], np.ndarray]]:
+    try:
+        return _embed(parsed_files, question, backend, model)
+    except EmbeddingError:
+        _warn_embedding_failed()
+        return None
+
+
+def _warn_embedding_failed():
+    warning_message = 'Sorry, we are experiencing high traffic. \n Please, try again in a minute or try a smaller file'
+    st.sidebar.warning(warning_message, icon="⚠️")
+
+
+def _embed_in_background(parsed_files, question, backend, model) -> Future:
+    # one request per files and question in flight, the questions asked meanwhile get the same future
+    key = (model, question, *(parsed_file.digest for parsed_file in parsed_files))
+    with _EMBEDDINGS_IN_FLIGHT_LOCK:
+        future = _EMBEDDINGS_IN_FLIGHT.get(key)
+        if future is None:
+            future = _EMBEDDING_EXECUTOR.submit(_embed, parsed_files, question, backend, model)
+            _EMBEDDINGS_IN_FLIGHT[key] = future
+            future.add_done_callback(lambda _: _forget_in_flight(key))
+    return future
+
 
-    missing_embeddings = deque(islice(new_embeddings, 0, len(new_embeddings) - 1))
-    question_embedding = new_embeddings[-1]
+def _forget_in_flight(key: Hashable):
+    with _EMBEDDINGS_IN_FLIGHT_LOCK:
+        _EMBEDDINGS_IN_FLIGHT.pop(key, None)
 
-    _cache_missing_embeddings(parsed_files_without_embeddings, missing_embeddings.copy())
-    _populate_with_missing_embeddings(embeddings, missing_embeddings.copy())
-    embeddings.append(question_embedding)
-    return embeddings
 
+def _embed(parsed_files, question, backend, model) -> Tuple[List[EmbeddingMatrix], np.ndarray]:
+    # the matrices are kept here and not read back from the cache, which can evict them meanwhile
+    files_matrices = [get_parsed_file_embeddings_from_cache(parsed_file, model) for parsed_file in parsed_files]
+    files_indices_without_embeddings = []
+    for file_index, (parsed_file, file_matrix) in enumerate(zip(parsed_files, files_matrices)):
+        if file_matrix is not None:
+            LOGGER.info('Obtained embeddings from cache for %s.', parsed_file.name)
+            count_cache_requests('embeddings', hit=True)
+        else:
+            files_indices_without_embeddings.append(file_index)
+            count_cache_requests('embeddings', hit=False)
+    parsed_files_without_embeddings = [parsed_files[file_index] for file_index in files_indices_without_embeddings]
+
+    embedding_store = get_embedding_store(model)
+    files_embeddings = [embedding_store.get(parsed_file.paragraphs) for parsed_file in parsed_files_without_embeddings]
+    question_embedding, = embedding_store.get((question,))
+
+    # only the texts that were never embedded before are sent, each of them once
+    texts_without_embeddings = dict.fromkeys(chain(
+        (paragraph for parsed_file, file_embeddings in zip(parsed_files_without_embeddings, files_embeddings)
+         for paragraph, embedding in zip(parsed_file.paragraphs, file_embeddings) if embedding is None),
+        () if question_embedding is not None else (question,)))
+    texts_count = sum(map(len, files_embeddings)) + 1
+    count_cache_requests('embedding_store', hit=True, count=texts_count - len(texts_without_embeddings))
+    count_cache_requests('embedding_store', hit=False, count=len(texts_without_embeddings))
+
+    # every file is cached as soon as the last of its missing texts is embedded
+    files_missing_counts = [0] * len(parsed_files_without_embeddings)
+    files_by_text_without_embedding = defaultdict(list)
+    for i, parsed_file in enumerate(parsed_files_without_embeddings):
+        for paragraph in set(p for p, e in zip(parsed_file.paragraphs, files_embeddings[i]) if e is None):
+            files_by_text_without_embedding[paragraph].append(i)
+            files_missing_counts[i] += 1
+        if not files_missing_counts[i]:
+            files_matrices[files_indices_without_embeddings[i]] = _cache_file_embeddings(
+                parsed_file, model, files_embeddings[i], {})
+
+    new_embeddings = {}
+
+    def on_batch_embedded(batch, batch_embeddings):
+        embedding_store.put(batch, batch_embeddings)
+        new_embeddings.update(zip(batch, batch_embeddings))
+        for text in batch:
+            for i in files_by_text_without_embedding.get(text, ()):
+                files_missing_counts[i] -= 1
+                if not files_missing_counts[i]:
+                    files_matrices[files_indices_without_embeddings[i]] = _cache_file_embeddings(
+                        parsed_files_without_embeddings[i], model, files_embeddings[i], new_embeddings)
+
+    try:
+        embed_texts(tuple(texts_without_embeddings), backend, model, on_batch_embedded)
+    except EmbeddingError as e:
+        LOGGER.warning('%s Embeddings of the finished batches are kept.', e)
+        raise
+
+    if question_embedding is None:
+        question_embedding = new_embeddings[question]
 
-def _cache_missing_embeddings(parsed_files_without_embeddings: List[ParsedFile], missing_embeddings: Deque[float]):
-    for parsed_file in parsed_files_without_embeddings:
-        parsed_file_embeddings = []
-        for _ in parsed_file.paragraphs:
-            parsed_file_embeddings.append(missing_embeddings.popleft())
-        cache_parsed_file_embeddings(parsed_file, parsed_file_embeddings)
-        LOGGER.info('Cached embeddings for %s.', parsed_file.name)
+    return files_matrices, np.asarray(question_embedding, dtype=np.float32)
 
 
-def _populate_with_missing_embeddings(embeddings: List[Optional[float]], missing_embeddings: Deque[float]):
-    for i, embedding in enumerate(embeddings):
-        if embedding is None:
-            embeddings[i] = missing_embeddings.popleft()
+def _cache_file_embeddings(parsed_file: ParsedFile, model: str, stored_embeddings: Sequence,
+                           new_embeddings: Mapping) -> EmbeddingMatrix:
+    embeddings = [new_embeddings[paragraph] if embedding is None else embedding
+                  for paragraph, embedding in zip(parsed_file.paragraphs, stored_embeddings)]
+    file_embeddings = EmbeddingMatrix.from_embeddings(embeddings)
+    cache_parsed_file_embeddings(parsed_file, model, file_embeddings)
+    index_file_embeddings(parsed_file.digest, file_embeddings, model)
+    LOGGER.info('Cached embeddings for %s.', parsed_file.name)
+    return file_embeddings
@@ -0,0 +1,192 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+"""
+
+import os
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Sequence
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from ainfer.backends.factory import get_backend
+from ainfer.cache import cache_answer, get_answer_from_cache, build_answer_cache_key, build_summary_cache_key
+from ainfer.embeddings.store import get_embedding_store
+from ainfer.files.parse_file import parse_files
+from ainfer.generation import build_context, create_response, get_summary
+from ainfer.jobs import JobStatus, get_job_queue
+from ainfer.memory import SessionFiles, get_blob_store
+from ainfer.ranking import rank_paragraphs, choose_paragraphs_for_context
+from ainfer.types.files import File, FileFormat
+from ainfer.types.ranking import RankedParagraph
+
+LOGGER = logging.getLogger(__name__)
+COHERE_API_KEY = os.environ.get('COHERE_API_KEY', '')
+
+
+class Coalescer:
+    """
+    Runs a blocking function in the thread pool once per key at a time. Requests for a key that is in flight
+    await the same result, and a client that disconnects does not cancel the work the others are waiting for.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+
+    def run(self, key: Hashable, function: Callable, *args) -> Awaitable:
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(run_in_threadpool(function, *args))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return asyncio.shield(future)
+
+
+class ServiceFiles:
+    """Files ingested through the service, by their content hash. Contents are kept in the shared blob store."""
+
+    def __init__(self):
+        self._contents = SessionFiles(get_blob_store())  # keyed by the content hash instead of the name
+        self._names: Dict[str, str] = {}
+
+    def __contains__(self, file_id: str) -> bool:
+        return file_id in self._names
+
+    def ids(self) -> List[str]:
+        return list(self._names)
+
+    def add(self, file: File) -> str:
+        self._contents.add(File.with_digest(file.digest, file.value, file.digest))
+        self._names[file.digest] = file.name
+        return file.digest
+
+    def get(self, file_id: str) -> File:
+        return File.with_digest(self._names[file_id], self._contents.get(file_id).value, file_id)
+
+
+_FILES = ServiceFiles()
+_GENERATIONS = Coalescer()
+
+
+async def ingest(request: Request) -> JSONResponse:
+    # the file is the request body, its name with the format extension is in the path
+    name = request.path_params['name']
+    if not FileFormat.is_supported(name):
+        return JSONResponse({'error': 'Only PDF, DOCX and TXT files are supported.'}, status_code=415)
+    file = File(name=name, value=await request.body())
+    # the same content is ingested once, whether it comes from the service or from a UI session
+    backend = get_backend(api_key=COHERE_API_KEY)
+    # held by the request, so that sessions stopping the same file do not cancel it
+    holder = object()
+    job = get_job_queue().submit(file, backend, backend.embedding_model, holder)
+    try:
+        await run_in_threadpool(job.wait)
+    finally:
+        get_job_queue().detach(job, holder)
+    if job.status is not JobStatus.DONE:
+        return JSONResponse({'error': f'Failed ingesting the file: {job.error or job.status.value}.'}, status_code=500)
+    # only files that were ingested are asked about, a file that fails to parse would fail every question
+    file_id = _FILES.add(file)
+    return JSONResponse({'file_id': file_id, 'name': name, 'paragraphs': job.summary.paragraphs_count})
+
+
+async def ask(request: Request) -> JSONResponse:
+    body = await _read_json(request)
+    if body is None:
+        return JSONResponse({'error': 'The body must be a JSON object.'}, status_code=400)
+    question = body.get('question')
+    if not question:
+        return JSONResponse({'error': 'A question is required.'}, status_code=400)
+    file_ids = body.get('files') or _FILES.ids()
+    unknown_file_ids = [file_id for file_id in file_ids if file_id not in _FILES]
+    if unknown_file_ids:
+        return JSONResponse({'error': 'Unknown files.', 'files': unknown_file_ids}, status_code=404)
+
+    files = [_FILES.get(file_id) for file_id in file_ids]
+    paragraphs_for_context = await run_in_threadpool(_choose_paragraphs, files, question)
+    if not paragraphs_for_context:
+        return JSONResponse({'answer': None, 'paragraphs': []})
+
+    # answers are shared with the UI sessions, the same context and question are generated once
+    answer_key = build_answer_cache_key(paragraphs_for_context)
+    backend = get_backend(api_key=COHERE_API_KEY)
+    embedding_model = backend.embedding_model
+    question_embedding, = get_embedding_store(embedding_model).get((question,))
+    answer = get_answer_from_cache(answer_key, question, question_embedding, embedding_model, backend.generation_model)
+    if answer is None:
+        answer = await _GENERATIONS.run(('answer', answer_key, question), _generate_answer, question,
+                                        paragraphs_for_context, answer_key, question_embedding, embedding_model)
+
+    return JSONResponse({
+        'answer': answer,
+        'paragraphs': [{
+            'file_id': paragraph.file.digest,
+            'name': paragraph.file.name,
+            'paragraph_index': paragraph.paragraph_id.paragraph_index,
+            'similarity': paragraph.similarity,
+            'text': paragraph.paragraph,
+        } for paragraph in paragraphs_for_context],
+    })
+
+
+async def summarize(request: Request) -> JSONResponse:
+    body = await _read_json(request)
+    if body is None:
+        return JSONResponse({'error': 'The body must be a JSON object.'}, status_code=400)
+    text = body.get('text')
+    if not text:
+        return JSONResponse({'error': 'A text is required.'}, status_code=400)
+
+    summary_key = build_summary_cache_key(text)
+    generation_model = get_backend(api_key=COHERE_API_KEY).generation_model
+    summary = get_answer_from_cache(summary_key, text, generation_model=generation_model)
+    if summary is None:
+        summary = await _GENERATIONS.run(('summary', summary_key), _generate_summary, text, summary_key)
+    return JSONResponse({'summary': summary})
+
+
+async def _read_json(request: Request) -> Optional[dict]:
+    try:
+        body = await request.json()
+    except ValueError:  # malformed JSON or not UTF-8
+        return None
+    return body if isinstance(body, dict) else None
+
+
+def _choose_paragraphs(files: Sequence[File], question: str) -> Optional[Sequence[RankedParagraph]]:
+    backend = get_backend(api_key=COHERE_API_KEY)
+    ranked_paragraphs = rank_paragraphs(parse_files(files), question, backend, model=backend.embedding_model)
+    if not ranked_paragraphs:
+        return None
+    return list(choose_paragraphs_for_context(ranked_paragraphs, model=backend.embedding_model))
+
+
+def _generate_answer(question: str, paragraphs_for_context: Sequence[RankedParagraph], answer_key: str,
+                     question_embedding, embedding_model: str) -> str:
+    backend = get_backend(api_key=COHERE_API_KEY)
+    generation = create_response(question=question, paragraphs_for_context=build_context(paragraphs_for_context),
+                                 backend=backend, model=backend.generation_model)
+    answer = ''.join(generation).strip()
+    cache_answer(answer_key, question, answer, question_embedding, embedding_model, generation.model)
+    return answer
+
+
+def _generate_summary(text: str, summary_key: str) -> str:
+    backend = get_backend(api_key=COHERE_API_KEY)
+    generation = get_summary(context=text, backend=backend, model=backend.generation_model)
+    summary = ''.join(generation).strip()
+    cache_answer(summary_key, text, summary, generation_model=generation.model)
+    return summary
+
+
+APP = Starlette(routes=[
+    Route('/files/{name}', ingest, methods=['POST']),
+    Route('/ask', ask, methods=['POST']),
+    Route('/summarize', summarize, methods=['POST']),
+])
@@ -4,21 +4,150 @@
  Date: Feb 03 2023
 """
 
+import hashlib
 from enum import Enum
 from dataclasses import dataclass
-from typing import Tuple
+from collections.abc import Sequence
+from typing import Iterator, Tuple, Union
 
+import numpy as np
 
-@dataclass(frozen=True)
+Coordinates = Tuple[float, float, float, float, int]  # last coord is page number
+
+
+class Paragraphs(Sequence):
+    """Read-only sequence of paragraphs stored as one UTF-8 buffer and the offsets of every paragraph in it."""
+    __slots__ = ('text', 'offsets')
+
+    def __init__(self, text: bytes, offsets: np.ndarray):
+        self.text = text
+        self.offsets = offsets  # int64, paragraph i is text[offsets[i]:offsets[i + 1]]
+
+    @staticmethod
+    def from_strings(paragraphs) -> 'Paragraphs':
+        encoded_paragraphs = [paragraph.encode() for paragraph in paragraphs]
+        offsets = np.cumsum([0] + [len(paragraph) for paragraph in encoded_paragraphs], dtype=np.int64)
+        return Paragraphs(b''.join(encoded_paragraphs), offsets)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.text) + self.offsets.nbytes
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self[i] for i in range(*index.indices(len(self))))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('paragraph index out of range')
+        return self.text[self.offsets[index]:self.offsets[index + 1]].decode()
+
+    def __iter__(self) -> Iterator[str]:
+        offsets = self.offsets.tolist()
+        return (self.text[start:end].decode() for start, end in zip(offsets[:-1], offsets[1:]))
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Paragraphs):
+            return self.text == other.text and np.array_equal(self.offsets, other.offsets)
+        return isinstance(other, Sequence) and tuple(self) == tuple(other)
+
+
+class ParagraphsCoordinates(Sequence):
+    """Read-only sequence of paragraph coordinates backed by a float32 boxes array and an int32 pages array."""
+    __slots__ = ('boxes', 'pages')
+
+    def __init__(self, boxes: np.ndarray, pages: np.ndarray):
+        self.boxes = boxes  # float32 (paragraphs, 4): x0, y0, x1, y1
+        self.pages = pages  # int32 (paragraphs,)
+
+    @staticmethod
+    def from_tuples(paragraphs_coordinates) -> 'ParagraphsCoordinates':
+        coordinates = np.asarray(paragraphs_coordinates, dtype=np.float64).reshape(len(paragraphs_coordinates), 5)
+        return ParagraphsCoordinates(
+            np.ascontiguousarray(coordinates[:, :4], dtype=np.float32), coordinates[:, 4].astype(np.int32))
+
+    @property
+    def nbytes(self) -> int:
+        return self.boxes.nbytes + self.pages.nbytes
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+    def __getitem__(self, index) -> Coordinates:
+        if isinstance(index, slice):
+            return tuple(self[i] for i in range(*index.indices(len(self))))
+        x0, y0, x1, y1 = self.boxes[index].tolist()
+        return x0, y0, x1, y1, int(self.pages[index])
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, ParagraphsCoordinates):
+            return np.array_equal(self.boxes, other.boxes) and np.array_equal(self.pages, other.pages)
+        return isinstance(other, Sequence) and tuple(self) == tuple(other)
+
+
+@dataclass(frozen=True, eq=False)
 class File:
+    __slots__ = ('name', 'value', '_digest')
     name: str  # may be used to fetch highlighted version of file from session data
     value: bytes
 
+    @property
+    def digest(self) -> str:
+        # content hash, unlike the name it is the same for the same file in every session
+        try:
+            return self._digest
+        except AttributeError:
+            object.__setattr__(self, '_digest', hashlib.sha256(self.value).hexdigest())
+            return self._digest
+
+    @staticmethod
+    def with_digest(name: str, value: bytes, digest: str) -> 'File':
+        # for contents stored by their hash already, so that they are not hashed again
+        file = File(name=name, value=value)
+        object.__setattr__(file, '_digest', digest)
+        return file
+
+    # files are compared and hashed by the content hash, which is computed once per object
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and (self.name, self.digest) == (other.name, other.digest)
+
+    def __hash__(self) -> int:
+        return hash((self.name, self.digest))
 
-@dataclass(frozen=True)
+    def __reduce__(self):
+        return type(self), (self.name, self.value)
+
+
+@dataclass(frozen=True, eq=False)
 class ParsedFile(File):
-    paragraphs: Tuple[str]
-    paragraphs_coordinates: Tuple[Tuple[float, float, float, float, int]]  # last coord is page number
+    __slots__ = ('paragraphs', 'paragraphs_coordinates')
+    paragraphs: Paragraphs  # sequences of strings are packed on creation
+    paragraphs_coordinates: ParagraphsCoordinates  # sequences of Coordinates are packed on creation
+
+    def __post_init__(self):
+        if not isinstance(self.paragraphs, Paragraphs):
+            object.__setattr__(self, 'paragraphs', Paragraphs.from_strings(self.paragraphs))
+        if not isinstance(self.paragraphs_coordinates, ParagraphsCoordinates):
+            object.__setattr__(
+                self, 'paragraphs_coordinates', ParagraphsCoordinates.from_tuples(self.paragraphs_coordinates))
+
+    @staticmethod
+    def from_file(file: File, paragraphs: Union[Paragraphs, Sequence],
+                  paragraphs_coordinates: Union[ParagraphsCoordinates, Sequence]) -> 'ParsedFile':
+        parsed_file = ParsedFile(
+            name=file.name,
+            value=file.value,
+            paragraphs=paragraphs,
+            paragraphs_coordinates=paragraphs_coordinates)
+        if hasattr(file, '_digest'):
+            object.__setattr__(parsed_file, '_digest', file._digest)  # the same content, no need to hash it again
+        return parsed_file
+
+    def __reduce__(self):
+        return type(self), (self.name, self.value, self.paragraphs, self.paragraphs_coordinates)
 
 
 class FileFormat(str, Enum):
@@ -40,3 +169,7 @@ class FileFormat(str, Enum):
     @staticmethod
     def is_txt(filename: str) -> bool:
         return filename.endswith(FileFormat.TXT.dotted())
+
+    @staticmethod
+    def is_supported(filename: str) -> bool:
+        return any(filename.endswith(file_format.dotted()) for file_format in FileFormat)
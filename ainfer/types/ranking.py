@@ -4,8 +4,48 @@
  Date: Feb 03 2023
 """
 
-from typing import Tuple
+from dataclasses import dataclass
+from typing import NamedTuple, Optional, Sequence
+
+import numpy as np
 
 from ainfer.types.files import ParsedFile
 
-RankedParagraph = Tuple[ParsedFile, str, float]
+class ParagraphId(NamedTuple):
+    file_index: int  # index of the file in the ranked files
+    paragraph_index: int  # index of the paragraph in ParsedFile.paragraphs
+
+
+class RankedParagraph(NamedTuple):
+    file: ParsedFile
+    paragraph: str
+    paragraph_id: ParagraphId
+    similarity: float
+
+
+@dataclass(frozen=True, eq=False)
+class EmbeddingMatrix:
+    vectors: np.ndarray  # float32, one contiguous row per paragraph
+    norms: np.ndarray  # float32, precomputed L2 norm of every row
+
+    @staticmethod
+    def from_embeddings(embeddings: Sequence[Sequence[float]]) -> 'EmbeddingMatrix':
+        if len(embeddings):
+            vectors = np.ascontiguousarray(embeddings, dtype=np.float32)
+        else:
+            vectors = np.empty((0, 0), dtype=np.float32)
+        return EmbeddingMatrix(vectors=vectors, norms=np.linalg.norm(vectors, axis=1))
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    def similarities(self, embedding: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Cosine similarities of all rows, or of the given ones only, to the embedding,
+        computed in one matrix-vector product.
+        """
+        if not len(self):
+            return np.empty(0, dtype=np.float32)
+        vectors, norms = (self.vectors, self.norms) if rows is None else (self.vectors[rows], self.norms[rows])
+        denominators = np.maximum(norms * np.linalg.norm(embedding), np.finfo(np.float32).tiny)
+        return (vectors @ embedding) / denominators
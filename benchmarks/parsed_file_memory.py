@@ -0,0 +1,74 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+
+ Compares the memory taken by parsed files stored as tuples of Python objects
+ with the compact ParsedFile representation.
+ Run from the repository root: `python -m benchmarks.parsed_file_memory`.
+"""
+
+import gc
+import json
+import random
+import argparse
+import tracemalloc
+from typing import Callable, List
+
+from ainfer.types.files import ParsedFile
+
+WORDS = ('the', 'model', 'embedding', 'protein', 'equation', 'results', 'section', 'we', 'propose', 'über', 'α')
+
+
+def synthetic_paragraphs(paragraphs_count: int, seed: int) -> List[str]:
+    generator = random.Random(seed)
+    return [' '.join(generator.choice(WORDS) for _ in range(generator.randint(20, 120))) for _ in range(paragraphs_count)]
+
+
+def synthetic_coordinates(paragraphs_count: int, seed: int) -> List[tuple]:
+    generator = random.Random(seed)
+    return [(generator.uniform(0, 600), generator.uniform(0, 800), generator.uniform(0, 600), generator.uniform(0, 800), i // 20)
+            for i in range(paragraphs_count)]
+
+
+def measure(build: Callable[[], list]) -> int:
+    gc.collect()
+    tracemalloc.start()
+    objects = build()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return allocated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--paragraphs', type=int, default=2000, help='paragraphs per file')
+    args = parser.parse_args()
+
+    # the texts are built outside of the measurement and decoded from bytes,
+    # like the paragraphs that fitz returns, so that no string is shared between the representations
+    texts = [[paragraph.encode() for paragraph in synthetic_paragraphs(args.paragraphs, seed)] for seed in range(args.files)]
+    coordinates = [synthetic_coordinates(args.paragraphs, seed) for seed in range(args.files)]
+
+    tuples_bytes = measure(lambda: [
+        (tuple(text.decode() for text in file_texts), tuple(tuple(c) for c in file_coordinates))
+        for file_texts, file_coordinates in zip(texts, coordinates)])
+
+    parsed_files_bytes = measure(lambda: [
+        ParsedFile(name=f'{i}.pdf', value=b'', paragraphs=[text.decode() for text in file_texts],
+                   paragraphs_coordinates=file_coordinates)
+        for i, (file_texts, file_coordinates) in enumerate(zip(texts, coordinates))])
+
+    print(json.dumps({
+        'files': args.files,
+        'paragraphs_per_file': args.paragraphs,
+        'tuples_bytes': tuples_bytes,
+        'parsed_files_bytes': parsed_files_bytes,
+        'ratio': round(tuples_bytes / parsed_files_bytes, 2),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+ Authors: Vlad Smetanskyi, Ihor Neporozhnii, Oleksandra Ostapenko
+ Status: In development
+ Date: Feb 03 2023
+
+ Measures every stage of the ingestion-to-answer pipeline on synthetic PDFs, with the fake backend instead of
+ the Cohere API, and prints throughput, p50/p95 latency and peak memory of each stage as JSON.
+ Every repetition gets PDFs it has never seen, so that no stage is served from a cache.
+ Peak memory is traced in this process only, memory of the parse workers is not included.
+ Run from the repository root: `python -m benchmarks.pipeline --files 1 4 --pages 10 50`.
+"""
+
+import gc
+import json
+import time
+import random
+import argparse
+import itertools
+import tempfile
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+import fitz
+import numpy as np
+
+import ainfer.embeddings.store
+import ainfer.files.highlight_file
+from ainfer.backends.fake import FakeBackend
+from ainfer.files.highlight_file import highlight_paragraphs_in_files
+from ainfer.files.parse_file import PARSE_WORKERS, parse_files
+from ainfer.prompt import build_answer_prompt
+from ainfer.ranking import RETRIEVAL_MODE, rank_paragraphs, choose_paragraphs_for_context, get_embeddings
+from ainfer.types.files import File
+
+WORDS = ('the', 'model', 'embedding', 'protein', 'equation', 'results', 'section', 'we', 'propose', 'über', 'α',
+         'gradient', 'sequence', 'BRCA1', 'lattice', 'theorem', 'sample', 'variance', 'catalyst', 'spectrum')
+QUESTION = 'What do the results propose about the protein sequence?'
+PAGE_MARGIN = 50
+PARAGRAPH_GAP = 10
+
+
+def synthetic_pdf(pages_count: int, paragraphs_per_page: int, seed: int) -> bytes:
+    """A PDF of random paragraphs laid out one under another, each of them a separate text block."""
+    generator = random.Random(seed)
+    pdf = fitz.open()
+    for _ in range(pages_count):
+        page = pdf.new_page()
+        height = (page.rect.height - 2 * PAGE_MARGIN) / paragraphs_per_page
+        for i in range(paragraphs_per_page):
+            top = PAGE_MARGIN + i * height
+            text = ' '.join(generator.choice(WORDS) for _ in range(generator.randint(10, 40)))
+            page.insert_textbox(fitz.Rect(PAGE_MARGIN, top, page.rect.width - PAGE_MARGIN, top + height - PARAGRAPH_GAP),
+                                text, fontsize=min(9, height / 5))
+    value = pdf.tobytes()
+    pdf.close()
+    return value
+
+
+def synthetic_files(files_count: int, pages_count: int, paragraphs_per_page: int, seed: int) -> List[File]:
+    return [File(name=f'{seed}-{i}.pdf', value=synthetic_pdf(pages_count, paragraphs_per_page, seed * 1000 + i))
+            for i in range(files_count)]
+
+
+def run_pipeline(files: List[File], backend: FakeBackend, workers: int) -> Dict[str, Callable]:
+    """The stages in pipeline order, each taking the output of the previous one."""
+    model = backend.embedding_model
+    return {
+        'parse': lambda _: parse_files(files, workers),
+        'embed': lambda parsed_files: (parsed_files, get_embeddings(parsed_files, QUESTION, backend, model)),
+        'rank': lambda embedded: rank_paragraphs(embedded[0], QUESTION, backend, model, mode=RETRIEVAL_MODE),
+        'choose': lambda ranked: choose_paragraphs_for_context(ranked, model=model),
+        'highlight': lambda chosen: (chosen, highlight_paragraphs_in_files(chosen)),
+        'generate': lambda highlighted: ''.join(backend.generate(
+            build_answer_prompt(QUESTION, [paragraph.paragraph for paragraph in highlighted[0]]),
+            backend.generation_model, max_tokens=500, temperature=0.3)),
+    }
+
+
+def measure_stage(stage: Callable, argument, trace_memory: bool) -> Tuple[object, float, int]:
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = stage(argument)
+    elapsed = time.perf_counter() - start
+    peak = 0
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def benchmark(files_count: int, pages_count: int, paragraphs_per_page: int, repetitions: int, workers: int,
+              backend: FakeBackend, seed: int) -> Dict:
+    durations, peaks = {}, {}
+    paragraphs_count = 0
+    # the first run is traced for memory only, tracing slows the code down too much to time it
+    for repetition in range(repetitions + 1):
+        files = synthetic_files(files_count, pages_count, paragraphs_per_page, seed + repetition)
+        result = None
+        for name, stage in run_pipeline(files, backend, workers).items():
+            result, elapsed, peak = measure_stage(stage, result, trace_memory=not repetition)
+            if repetition:
+                durations.setdefault(name, []).append(elapsed)
+            else:
+                peaks[name] = peak
+            if name == 'parse':
+                paragraphs_count = sum(len(parsed_file.paragraphs) for parsed_file in result)
+
+    # what a second of every stage gets through
+    units = {
+        'parse': (files_count * pages_count, 'pages'),
+        'embed': (paragraphs_count, 'paragraphs'),
+        'rank': (1, 'questions'),
+        'choose': (1, 'questions'),
+        'highlight': (1, 'questions'),
+        'generate': (1, 'answers'),
+    }
+    stages = {}
+    for name, stage_durations in durations.items():
+        count, unit = units[name]
+        stages[name] = {
+            'p50_ms': round(float(np.percentile(stage_durations, 50)) * 1000, 3),
+            'p95_ms': round(float(np.percentile(stage_durations, 95)) * 1000, 3),
+            'throughput': round(count / float(np.mean(stage_durations)), 2),
+            'throughput_unit': f'{unit}/s',
+            'peak_memory_bytes': peaks[name],
+        }
+
+    return {
+        'files': files_count,
+        'pages_per_file': pages_count,
+        'paragraphs_per_page': paragraphs_per_page,
+        'paragraphs': paragraphs_count,
+        'stages': stages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--pages', type=int, nargs='+', default=[10], help='pages per file')
+    parser.add_argument('--paragraphs', type=int, nargs='+', default=[8], help='paragraphs per page')
+    parser.add_argument('--repetitions', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=PARSE_WORKERS)
+    parser.add_argument('--embed-latency', type=float, default=0.0, help='seconds per embed request')
+    parser.add_argument('--token-latency', type=float, default=0.0, help='seconds per generated token')
+    parser.add_argument('--output', help='file to write the report to, stdout by default')
+    args = parser.parse_args()
+
+    # caches on disk are kept apart from the ones of the app, so that runs do not interfere with it or each other
+    folder = tempfile.mkdtemp(prefix='ainfer-benchmark-')
+    ainfer.embeddings.store.DEFAULT_EMBEDDINGS_FOLDER = f'{folder}/embeddings'
+    ainfer.files.highlight_file.DEFAULT_HIGHLIGHT_FOLDER = f'{folder}/highlights'
+
+    backend = FakeBackend(embed_latency=args.embed_latency, token_latency=args.token_latency)
+    report = {
+        'repetitions': args.repetitions,
+        'workers': args.workers,
+        'retrieval_mode': RETRIEVAL_MODE,
+        'embed_latency': args.embed_latency,
+        'token_latency': args.token_latency,
+        # every configuration gets its own seeds, the same for every run
+        'results': [benchmark(files_count, pages_count, paragraphs_per_page, args.repetitions, args.workers, backend,
+                              seed=i * (args.repetitions + 1))
+                    for i, (files_count, pages_count, paragraphs_per_page)
+                    in enumerate(itertools.product(args.files, args.pages, args.paragraphs))],
+    }
+
+    report = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()